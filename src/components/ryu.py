@@ -3,25 +3,1106 @@
 ##
 import time
 import json
+import bisect
+import hashlib
+import heapq
+import hmac
+import ipaddress
+import itertools
+import math
+import os
+import random
+import socket
+import struct
+import zlib
+from collections import OrderedDict
+import numpy as np
 from ryu.base import app_manager
 from ryu.controller import ofp_event
 from ryu.controller.handler import CONFIG_DISPATCHER, MAIN_DISPATCHER, DEAD_DISPATCHER
 from ryu.controller.handler import set_ev_cls
 from ryu.ofproto import ofproto_v1_3
-from ryu.lib.packet import packet, ethernet, ether_types, ipv4
+from ryu.lib.packet import packet, ethernet, ether_types, ipv4, arp, vlan
 from ryu.lib import hub
-from prometheus_client import start_http_server, Counter, Gauge
+from prometheus_client import start_http_server, Counter, Gauge, Histogram
 from ryu.app.wsgi import WSGIApplication, ControllerBase, route
 from webob import Response
 # REST API URL Prefix
 simple_switch_instance_name = 'simple_switch_api'
 url_connected_ips = '/connected_ips'
+url_hosts = '/hosts'
+url_host_to_switch = '/host_to_switch'
 url_blocked_ips = '/blocked_ips'
 url_block_ip = '/block_ip'
 url_unblock_ip = '/unblock_ip'
 url_ports = '/ports'
 url_block_port = '/block_port'
 url_unblock_port = '/unblock_port'
+url_top_talkers = '/top_talkers'
+url_block_ips = '/block_ips'
+url_unblock_ips = '/unblock_ips'
+url_block_ports = '/block_ports'
+url_unblock_ports = '/unblock_ports'
+url_events = '/events'
+url_topology = '/topology'
+url_throughput_history = '/throughput_history'
+url_thresholds = '/thresholds'
+url_threshold = '/threshold'
+
+# Cookie carried by every flow installed by MAC learning. Forwarding entries
+# restored from saved state at reconnect carry their own cookie, sharing the
+# low bit so one delete masked with FORWARDING_COOKIE_MASK removes both kinds.
+LEARNED_FLOW_COOKIE = 0x1
+RESTORED_FLOW_COOKIE = 0x3
+FORWARDING_COOKIE_MASK = 0x1
+# Learned in_port/eth_src/eth_dst flows win over the eth_dst-only restored ones
+LEARNED_FLOW_PRIORITY = 2
+RESTORED_FLOW_PRIORITY = 1
+
+# Port threshold states; a port without an entry is 'normal'
+PORT_NORMAL = 'normal'
+PORT_ABOVE = 'above'                # over threshold, blocked when block_window runs out
+PORT_BLOCKED = 'blocked'            # blocked, still over threshold
+PORT_UNBLOCKING = 'unblocking'      # blocked, under threshold; unblocked when unlock_timeout runs out
+PORT_RECENT = 'recently_unblocked'  # going over again within reblock_window blocks at once
+
+ETH_TYPE_8021Q = 0x8100
+_MAC_FORMAT = '%02x:%02x:%02x:%02x:%02x:%02x'
+
+
+def parse_eth_ipv4(data):
+    # Fast path for packet-in: read only the fields the handler needs straight
+    # from the raw frame instead of building a full ryu Packet object tree.
+    # Returns (dst_mac, src_mac, ethertype, src_ip) or None for a runt frame.
+    # One 802.1Q tag is skipped so ethertype/src_ip describe the inner payload.
+    if len(data) < 14:
+        return None
+    dst = _MAC_FORMAT % tuple(data[0:6])
+    src = _MAC_FORMAT % tuple(data[6:12])
+    ethertype = (data[12] << 8) | data[13]
+    offset = 14
+    if ethertype == ETH_TYPE_8021Q and len(data) >= 18:
+        ethertype = (data[16] << 8) | data[17]
+        offset = 18
+    src_ip = None
+    if ethertype == ether_types.ETH_TYPE_IP and len(data) >= offset + 20:
+        src_ip = socket.inet_ntoa(bytes(data[offset + 12:offset + 16]))
+    return dst, src, ethertype, src_ip
+
+
+def parse_packet(data):
+    # Slow path with the same result as parse_eth_ipv4, built on ryu's full
+    # packet parser: one 802.1Q tag is skipped here as well, so a tagged frame
+    # is handled the same whichever parser runs
+    if len(data) < 14:
+        return None
+    pkt = packet.Packet(data)
+    eth = pkt.get_protocols(ethernet.ethernet)[0]
+    ethertype = eth.ethertype
+    if ethertype == ETH_TYPE_8021Q and len(data) >= 18:
+        ethertype = pkt.get_protocols(vlan.vlan)[0].ethertype
+    ip_pkt = pkt.get_protocol(ipv4.ipv4) if ethertype == ether_types.ETH_TYPE_IP else None
+    src_ip = ip_pkt.src if ip_pkt else None
+    return eth.dst, eth.src, ethertype, src_ip
+
+
+def parse_arp(data):
+    # (opcode, sender MAC, sender IP, target IP) of an Ethernet/IPv4 ARP frame,
+    # or None; same raw-byte approach and 802.1Q handling as parse_eth_ipv4
+    offset = 18 if len(data) >= 18 and ((data[12] << 8) | data[13]) == ETH_TYPE_8021Q else 14
+    if len(data) < offset + 28:
+        return None
+    if data[offset:offset + 6] != b'\x00\x01\x08\x00\x06\x04':  # Ethernet, IPv4, 6, 4
+        return None
+    opcode = (data[offset + 6] << 8) | data[offset + 7]
+    return (opcode, _MAC_FORMAT % tuple(data[offset + 8:offset + 14]),
+            socket.inet_ntoa(bytes(data[offset + 14:offset + 18])),
+            socket.inet_ntoa(bytes(data[offset + 24:offset + 28])))
+
+
+def build_arp_reply(src_mac, src_ip, dst_mac, dst_ip):
+    # Ethernet + ARP reply frame "src_ip is at src_mac", addressed to dst_mac
+    src = bytes.fromhex(src_mac.replace(':', ''))
+    dst = bytes.fromhex(dst_mac.replace(':', ''))
+    return (dst + src + b'\x08\x06' + b'\x00\x01\x08\x00\x06\x04\x00\x02' +
+            src + socket.inet_aton(src_ip) + dst + socket.inet_aton(dst_ip))
+
+
+def parse_block_entry(entry):
+    # IPv4 address or CIDR prefix -> IPv4Network; host bits of a prefix are dropped.
+    # Only strings: ip_network() would also turn a JSON number into an address.
+    if not isinstance(entry, str):
+        raise ValueError('Not an IP address or prefix string: %s' % json.dumps(entry, default=repr))
+    network = ipaddress.ip_network(entry, strict=False)
+    if network.version != 4:
+        raise ValueError('Only IPv4 addresses and prefixes can be blocked: %s' % entry)
+    return network
+
+
+def block_entry_key(network):
+    # How a block list entry is stored and shown: plain address for a /32
+    if network.prefixlen == 32:
+        return str(network.network_address)
+    return str(network)
+
+
+class PrefixTrie(object):
+    # Binary trie of IPv4 prefixes. Each node is [zero child, one child, stored
+    # network or None], so a lookup walks at most 32 nodes.
+    def __init__(self):
+        self.root = [None, None, None]
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def insert(self, network):
+        node = self.root
+        addr = int(network.network_address)
+        for depth in range(network.prefixlen):
+            bit = (addr >> (31 - depth)) & 1
+            if node[bit] is None:
+                node[bit] = [None, None, None]
+            node = node[bit]
+        if node[2] is None:
+            self.count += 1
+        node[2] = network
+
+    def remove(self, network):
+        path = [self.root]
+        addr = int(network.network_address)
+        for depth in range(network.prefixlen):
+            node = path[-1][(addr >> (31 - depth)) & 1]
+            if node is None:
+                return
+            path.append(node)
+        if path[-1][2] is None:
+            return
+        path[-1][2] = None
+        self.count -= 1
+        # Prune the branch back up to the last node still in use
+        for depth in range(network.prefixlen, 0, -1):
+            node = path[depth]
+            if node[0] is not None or node[1] is not None or node[2] is not None:
+                break
+            path[depth - 1][(addr >> (32 - depth)) & 1] = None
+
+    def covering(self, network):
+        # Stored prefixes that contain `network` (itself included), shortest first
+        found = []
+        node = self.root
+        addr = int(network.network_address)
+        for depth in range(network.prefixlen + 1):
+            if node[2] is not None:
+                found.append(node[2])
+            if depth == network.prefixlen:
+                break
+            node = node[(addr >> (31 - depth)) & 1]
+            if node is None:
+                break
+        return found
+
+    def covered(self, network):
+        # Stored prefixes inside `network` (itself included)
+        node = self.root
+        addr = int(network.network_address)
+        for depth in range(network.prefixlen):
+            node = node[(addr >> (31 - depth)) & 1]
+            if node is None:
+                return []
+        return list(self._walk(node))
+
+    def networks(self):
+        return list(self._walk(self.root))
+
+    def _walk(self, node):
+        stack = [node]
+        while stack:
+            node = stack.pop()
+            if node[2] is not None:
+                yield node[2]
+            for child in (node[1], node[0]):
+                if child is not None:
+                    stack.append(child)
+
+
+class StateSnapshot(object):
+    # Pre-serialized JSON for the REST views. Every change bumps a global
+    # version and invalidates one section; the section is serialized again on
+    # its next read, so bursts of changes cost one serialization.
+    def __init__(self):
+        self.version = 0
+        self.sections = {}  # name -> [version, builder, body]
+        self.changed = hub.Event()
+
+    def register(self, name, builder):
+        self.sections[name] = [self.version, builder, None]
+
+    def touch(self, name):
+        self.version += 1
+        entry = self.sections[name]
+        entry[0] = self.version
+        entry[2] = None
+        # Wake every waiter; later waiters block on a fresh event
+        changed, self.changed = self.changed, hub.Event()
+        changed.set()
+
+    def get(self, name):
+        # (version, body bytes) of a section
+        entry = self.sections[name]
+        if entry[2] is None:
+            entry[2] = json.dumps(entry[1]()).encode('utf-8')
+        return entry[0], entry[2]
+
+    def changes(self, since):
+        return [name for name, entry in self.sections.items() if entry[0] > since]
+
+    def wait(self, since, timeout):
+        # Block until something changed after `since`; False on timeout
+        if self.version > since:
+            return True
+        return self.changed.wait(timeout)
+
+
+class StateJournal(object):
+    # Append-only JSON-lines journal of state changes plus a snapshot that is
+    # rewritten periodically (compaction), after which the journal starts over.
+    # Replaying the journal on top of the snapshot gives the latest state.
+    def __init__(self, directory, logger):
+        self.directory = directory
+        self.logger = logger
+        self.snapshot_path = os.path.join(directory, 'snapshot.json')
+        self.journal_path = os.path.join(directory, 'journal.log')
+        self.pending = []
+        self.file = None
+
+    def load(self):
+        # (snapshot dict, [journal records]); missing files mean empty state
+        snapshot = {}
+        records = []
+        try:
+            with open(self.snapshot_path, 'r') as f:
+                snapshot = json.load(f)
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            self.logger.error('Could not load controller snapshot: %s', e)
+        try:
+            with open(self.journal_path, 'r') as f:
+                for line in f:
+                    try:
+                        records.append(json.loads(line))
+                    except ValueError:
+                        break  # Torn last write
+        except FileNotFoundError:
+            pass
+        return snapshot, records
+
+    def open(self):
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            self.file = open(self.journal_path, 'a')
+        except OSError as e:
+            self.logger.error('Controller state will not be persisted: %s', e)
+
+    def append(self, *record):
+        self.pending.append(record)
+
+    def flush(self):
+        if self.pending and self.file is not None:
+            self.file.write(''.join(json.dumps(record) + '\n' for record in self.pending))
+            self.file.flush()
+        self.pending = []
+
+    def compact(self, snapshot):
+        # `snapshot` already reflects every pending record
+        self.pending = []
+        if self.file is None:
+            return
+        tmp_path = self.snapshot_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(snapshot, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.snapshot_path)
+        self.file.close()
+        self.file = open(self.journal_path, 'w')
+
+
+class TokenBucket(object):
+    __slots__ = ('rate', 'burst', 'tokens', 'stamp')
+
+    def __init__(self, rate, burst, now):
+        self.rate = rate      # tokens per second
+        self.burst = burst    # bucket size
+        self.tokens = burst
+        self.stamp = now
+
+    def consume(self, now):
+        # Refill for the time elapsed since the last call, then take one token
+        tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+        if tokens < 1:
+            self.tokens = tokens
+            return False
+        self.tokens = tokens - 1
+        return True
+
+
+class TimerWheel(object):
+    # Hashed timing wheel: O(1) schedule and cancel, advance() returns the keys
+    # whose deadline has passed. Deadlines further out than one revolution stay
+    # in their slot and are checked again on the next pass.
+    def __init__(self, tick, slots, now):
+        self.tick = tick
+        self.slots = [{} for _ in range(slots)]
+        self.where = {}  # key -> slot index
+        self.current = int(now // tick)
+
+    def __len__(self):
+        return len(self.where)
+
+    def __contains__(self, key):
+        return key in self.where
+
+    def schedule(self, key, deadline):
+        self.cancel(key)
+        tick = max(-int(-deadline // self.tick), self.current + 1)
+        index = tick % len(self.slots)
+        self.slots[index][key] = deadline
+        self.where[key] = index
+
+    def cancel(self, key):
+        index = self.where.pop(key, None)
+        if index is not None:
+            del self.slots[index][key]
+
+    def advance(self, now):
+        target = int(now // self.tick)
+        expired = []
+        steps = min(target - self.current, len(self.slots))
+        for tick in range(self.current + 1, self.current + 1 + steps):
+            slot = self.slots[tick % len(self.slots)]
+            due = [key for key, deadline in slot.items() if deadline <= now]
+            for key in due:
+                del slot[key]
+                del self.where[key]
+            expired.extend(due)
+        self.current = max(self.current, target)
+        return expired
+
+
+class HostTable(OrderedDict):
+    # Per-switch learning table kept in LRU order and bounded to `capacity`
+    def __init__(self, capacity):
+        super(HostTable, self).__init__()
+        self.capacity = capacity
+
+    def learn(self, key, value):
+        # Returns the (key, value) pushed out to make room, if any
+        if key in self:
+            self.move_to_end(key)
+        self[key] = value
+        if len(self) > self.capacity:
+            return self.popitem(last=False)
+        return None
+
+
+class Host(object):
+    __slots__ = ('ip', 'dpid', 'port_no', 'last_seen')
+
+    def __init__(self, last_seen):
+        self.ip = None
+        self.dpid = None      # edge port the host attaches to, None until seen on one
+        self.port_no = None
+        self.last_seen = last_seen
+
+
+class HostInventory(object):
+    # Every host seen, keyed by MAC in LRU order (so also in last_seen order),
+    # with an IP -> MAC index. Hosts are also kept sorted by sort_key overall,
+    # per switch and per port, so a filtered page is a slice and a subnet is
+    # one bisect range.
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.hosts = OrderedDict()  # mac -> Host
+        self.by_ip = {}
+        self.order = []         # sorted sort keys of every host
+        self.switch_order = {}  # dpid -> sorted sort keys
+        self.port_order = {}    # (dpid, port_no) -> sorted sort keys
+
+    def __len__(self):
+        return len(self.hosts)
+
+    @staticmethod
+    def sort_key(mac, ip):
+        # By IP; hosts with no IP come last ordered by MAC
+        if ip is None:
+            return 1, 0, '', mac
+        return 0, struct.unpack('!I', socket.inet_aton(ip))[0], ip, mac
+
+    def _orders(self, host):
+        # The sorted lists a host is in
+        if host.dpid is None:
+            return [self.order]
+        return [self.order, self.switch_order[host.dpid], self.port_order[(host.dpid, host.port_no)]]
+
+    def touch(self, mac, now):
+        # Refresh (or add) a host; returns the MAC evicted to make room, if any
+        host = self.hosts.get(mac)
+        if host is not None:
+            host.last_seen = now
+            self.hosts.move_to_end(mac)
+            return None
+        self.hosts[mac] = Host(now)
+        bisect.insort(self.order, self.sort_key(mac, None))
+        if len(self.hosts) > self.capacity:
+            evicted = next(iter(self.hosts))
+            self.remove(evicted)
+            return evicted
+        return None
+
+    def set_ip(self, mac, ip):
+        # True when the host's IP changed; an address taken over from another MAC leaves that one without
+        host = self.hosts[mac]
+        if host.ip == ip:
+            return False
+        if host.ip is not None:
+            del self.by_ip[host.ip]
+        owner = self.by_ip.get(ip)
+        if owner is not None:
+            self._resort(owner, self.hosts[owner], None)
+        self.by_ip[ip] = mac
+        self._resort(mac, host, ip)
+        return True
+
+    def _resort(self, mac, host, ip):
+        # Give a host a new IP and move it to its place in the sorted lists
+        old = self.sort_key(mac, host.ip)
+        new = self.sort_key(mac, ip)
+        for order in self._orders(host):
+            del order[bisect.bisect_left(order, old)]
+            bisect.insort(order, new)
+        host.ip = ip
+
+    def locate(self, mac, dpid, port_no):
+        # Move a host to (dpid, port_no), or unlocate it with None; returns the old location
+        host = self.hosts[mac]
+        old = (host.dpid, host.port_no) if host.dpid is not None else None
+        key = self.sort_key(mac, host.ip)
+        if old is not None:
+            for index, index_key in ((self.switch_order, host.dpid), (self.port_order, old)):
+                order = index[index_key]
+                del order[bisect.bisect_left(order, key)]
+                if not order:
+                    del index[index_key]
+        host.dpid = dpid
+        host.port_no = port_no
+        if dpid is not None:
+            bisect.insort(self.switch_order.setdefault(dpid, []), key)
+            bisect.insort(self.port_order.setdefault((dpid, port_no), []), key)
+        return old
+
+    def remove(self, mac):
+        host = self.hosts.get(mac)
+        if host is None:
+            return
+        self.locate(mac, None, None)
+        del self.order[bisect.bisect_left(self.order, self.sort_key(mac, host.ip))]
+        if host.ip is not None:
+            del self.by_ip[host.ip]
+        del self.hosts[mac]
+
+    def expire(self, cutoff):
+        # Remove the hosts not seen since `cutoff`; returns their MACs
+        expired = []
+        for mac, host in self.hosts.items():
+            if host.last_seen >= cutoff:
+                break
+            expired.append(mac)
+        for mac in expired:
+            self.remove(mac)
+        return expired
+
+    def mac_for(self, ip):
+        return self.by_ip.get(ip)
+
+    def ip_of(self, mac):
+        host = self.hosts.get(mac)
+        return host.ip if host is not None else None
+
+    def location(self, mac):
+        host = self.hosts.get(mac)
+        if host is None or host.dpid is None:
+            return None
+        return host.dpid, host.port_no
+
+    def ips(self):
+        return [key[2] for key in self.order[:bisect.bisect_left(self.order, (1,))]]
+
+    def macs_on(self, dpid, port_no):
+        return [key[3] for key in self.port_order.get((dpid, port_no), ())]
+
+    def select(self, dpid=None, port_no=None, network=None):
+        # (sorted keys, start, end): the hosts on a switch / port and in an
+        # IPv4 network are keys[start:end]
+        if dpid is None:
+            order = self.order
+        elif port_no is None:
+            order = self.switch_order.get(dpid, [])
+        else:
+            order = self.port_order.get((dpid, port_no), [])
+        if network is None:
+            return order, 0, len(order)
+        return (order, bisect.bisect_left(order, (0, int(network.network_address))),
+                bisect.bisect_left(order, (0, int(network.broadcast_address) + 1)))
+
+
+class PortStatsTable(object):
+    # Port counters of one switch held in NumPy arrays, one row per port, so a
+    # whole stats reply is turned into rates and threshold masks in a few array
+    # operations instead of a dict rebuild per port
+    _COLUMNS = ('rx_bytes', 'tx_bytes', 'timestamp', 'rx_rate', 'tx_rate',
+                'rx_ewma', 'tx_ewma', 'threshold')
+
+    def __init__(self):
+        self.index = {}  # port_no -> row
+        self.port_nos = np.zeros(0, dtype=np.int64)
+        for name in self._COLUMNS:
+            setattr(self, name, np.zeros(0))
+        self.seen = np.zeros(0, dtype=bool)      # row holds a previous counter sample
+        self.has_rate = np.zeros(0, dtype=bool)  # row holds a computed rate
+        # Switches report the same port list every time, so the row lookup is cached
+        self._last_ports = None
+        self._last_rows = None
+
+    def rows(self, port_nos, threshold_for):
+        if port_nos == self._last_ports:
+            return self._last_rows
+        if len(port_nos) == 1 and port_nos[0] in self.index:
+            # Single-port (hot port) replies must not evict the full reply's rows
+            return np.array([self.index[port_nos[0]]], dtype=np.intp)
+        new_ports = [port_no for port_no in port_nos if port_no not in self.index]
+        if new_ports:
+            self._grow(new_ports, threshold_for)
+        rows = np.fromiter((self.index[port_no] for port_no in port_nos),
+                           dtype=np.intp, count=len(port_nos))
+        self._last_ports = port_nos
+        self._last_rows = rows
+        return rows
+
+    def _grow(self, port_nos, threshold_for):
+        start = len(self.port_nos)
+        count = len(port_nos)
+        for offset, port_no in enumerate(port_nos):
+            self.index[port_no] = start + offset
+        self.port_nos = np.concatenate((self.port_nos, np.array(port_nos, dtype=np.int64)))
+        for name in self._COLUMNS:
+            setattr(self, name, np.concatenate((getattr(self, name), np.zeros(count))))
+        self.seen = np.concatenate((self.seen, np.zeros(count, dtype=bool)))
+        self.has_rate = np.concatenate((self.has_rate, np.zeros(count, dtype=bool)))
+        self.threshold[start:] = [threshold_for(port_no) for port_no in port_nos]
+
+    def refresh_thresholds(self, threshold_for):
+        self.threshold[:] = [threshold_for(int(port_no)) for port_no in self.port_nos]
+
+    def update(self, rows, rx_bytes, tx_bytes, now, alpha):
+        # Store a new counter sample for `rows` and return the mask of those
+        # rows that produced a rate (i.e. had a previous sample)
+        interval = now - self.timestamp[rows]
+        valid = self.seen[rows] & (interval > 0)
+        interval[~valid] = 1.0
+
+        # Counters that went backwards (switch restart, wrap) count as zero traffic
+        rx_rate = np.maximum(rx_bytes - self.rx_bytes[rows], 0) / interval
+        tx_rate = np.maximum(tx_bytes - self.tx_bytes[rows], 0) / interval
+
+        first = ~self.has_rate[rows]
+        rx_ewma = np.where(first, rx_rate, alpha * rx_rate + (1 - alpha) * self.rx_ewma[rows])
+        tx_ewma = np.where(first, tx_rate, alpha * tx_rate + (1 - alpha) * self.tx_ewma[rows])
+
+        updated = rows[valid]
+        self.rx_rate[updated] = rx_rate[valid]
+        self.tx_rate[updated] = tx_rate[valid]
+        self.rx_ewma[updated] = rx_ewma[valid]
+        self.tx_ewma[updated] = tx_ewma[valid]
+        self.has_rate[updated] = True
+
+        self.rx_bytes[rows] = rx_bytes
+        self.tx_bytes[rows] = tx_bytes
+        self.timestamp[rows] = now
+        self.seen[rows] = True
+        return valid
+
+
+def _port_map(nested, name):
+    # {"dpid": {"port": value}} from JSON -> {(dpid, port_no): float}; ValueError on any other shape
+    if not nested:
+        return {}
+    if not isinstance(nested, dict):
+        raise ValueError('"%s" must be an object of {dpid: {port: value}}' % name)
+    result = {}
+    for dpid, ports in nested.items():
+        if not isinstance(ports, dict):
+            raise ValueError('"%s" entry for switch %s must be an object of {port: value}, got %s'
+                             % (name, dpid, json.dumps(ports)))
+        for port_no, value in ports.items():
+            try:
+                result[(int(dpid), int(port_no))] = float(value)
+            except (TypeError, ValueError):
+                raise ValueError('"%s" has an invalid value for port %s of switch %s: %s'
+                                 % (name, port_no, dpid, json.dumps(value)))
+    return result
+
+
+def _config_number(config, name, default):
+    # A plain number field of link_bandwidth.json
+    value = config.get(name, default)
+    if value is None or isinstance(value, bool) or not isinstance(value, (int, float)):
+        raise ValueError('"%s" must be a number, got %s' % (name, json.dumps(value)))
+    return float(value)
+
+
+class ThresholdPolicy(object):
+    # link_bandwidth.json compiled into flat (dpid, port_no) lookups, all in
+    # bytes/s. The file is either the plain {dpid: {port: Mbps}} link list or
+    #   {"links": {dpid: {port: Mbps}}, "default_bandwidth": Mbps,
+    #    "threshold_percent": 80, "switch_percent": {dpid: percent},
+    #    "port_percent": {dpid: {port: percent}}, "overrides": {dpid: {port: bytes/s}}}
+    # A port's threshold is its bandwidth times the most specific percentage,
+    # unless the file or a runtime override (REST) sets it outright. Ports not
+    # in "links" get default_bandwidth, or the smallest listed link.
+    DEFAULT_THRESHOLD = 750000  # bytes/s when no bandwidth is known at all
+
+    def __init__(self, config=None, overrides=None):
+        # Every shape error is a ValueError, so startup and reload report it the same way
+        if config is None:
+            config = {}
+        if not isinstance(config, dict):
+            raise ValueError('link bandwidth config must be a JSON object, got %s' % type(config).__name__)
+        if all(str(key).isdigit() for key in config):
+            config = {'links': config}
+        self.capacity = dict((key, mbps * 10**6 / 8) for key, mbps in _port_map(config.get('links'), 'links').items())
+        if config.get('default_bandwidth') is not None:
+            self.default_capacity = _config_number(config, 'default_bandwidth', None) * 10**6 / 8
+        else:
+            self.default_capacity = min(self.capacity.values()) if self.capacity else None
+
+        percent = _config_number(config, 'threshold_percent', 80)
+        switch_percent = config.get('switch_percent') or {}
+        if not isinstance(switch_percent, dict):
+            raise ValueError('"switch_percent" must be an object of {dpid: percent}')
+        try:
+            switch_percent = dict((int(dpid), float(value)) for dpid, value in switch_percent.items())
+        except (TypeError, ValueError):
+            raise ValueError('"switch_percent" must map switch ids to numbers, got %s' % json.dumps(switch_percent))
+        port_percent = _port_map(config.get('port_percent'), 'port_percent')
+        if self.default_capacity is None:
+            self.default_threshold = self.DEFAULT_THRESHOLD
+            self.switch_default = {}
+        else:
+            self.default_threshold = self.default_capacity * percent / 100
+            self.switch_default = dict((dpid, self.default_capacity * value / 100)
+                                       for dpid, value in switch_percent.items())
+
+        self.thresholds = {}
+        for key in set(self.capacity).union(port_percent):
+            capacity = self.capacity.get(key, self.default_capacity)
+            if capacity is not None:
+                self.thresholds[key] = capacity * port_percent.get(key, switch_percent.get(key[0], percent)) / 100
+        self.thresholds.update(_port_map(config.get('overrides'), 'overrides'))
+        self.thresholds.update(overrides or {})
+
+    def threshold(self, dpid, port_no):
+        threshold = self.thresholds.get((dpid, port_no))
+        if threshold is None:
+            threshold = self.switch_default.get(dpid, self.default_threshold)
+        return threshold
+
+    def max_threshold(self, dpid, port_no):
+        # Link bandwidth of the port, None when unknown
+        return self.capacity.get((dpid, port_no), self.default_capacity)
+
+
+class ThroughputRing(object):
+    # Per-port rx/tx rates of one switch averaged into fixed time buckets: a ring
+    # of `slots` buckets of `resolution` seconds, one row per PortStatsTable row.
+    # Each slot remembers which bucket it holds, so a slot left over from an
+    # earlier lap (or never written) reads as empty without any clearing pass.
+    def __init__(self, resolution, slots):
+        self.resolution = resolution
+        self.slots = slots
+        self.bucket = np.full(slots, -1, dtype=np.int64)  # bucket number held by each slot
+        self.rx_sum = np.zeros((0, slots), dtype=np.float32)
+        self.tx_sum = np.zeros((0, slots), dtype=np.float32)
+        self.count = np.zeros((0, slots), dtype=np.uint16)
+
+    def grow(self, rows):
+        extra = rows - len(self.count)
+        if extra > 0:
+            self.rx_sum = np.concatenate((self.rx_sum, np.zeros((extra, self.slots), dtype=np.float32)))
+            self.tx_sum = np.concatenate((self.tx_sum, np.zeros((extra, self.slots), dtype=np.float32)))
+            self.count = np.concatenate((self.count, np.zeros((extra, self.slots), dtype=np.uint16)))
+
+    def add(self, rows, rx_rate, tx_rate, now):
+        bucket = int(now // self.resolution)
+        slot = bucket % self.slots
+        if self.bucket[slot] != bucket:
+            self.bucket[slot] = bucket
+            self.rx_sum[:, slot] = 0
+            self.tx_sum[:, slot] = 0
+            self.count[:, slot] = 0
+        self.rx_sum[rows, slot] += rx_rate
+        self.tx_sum[rows, slot] += tx_rate
+        self.count[rows, slot] += 1
+
+    def window(self, row, first, last):
+        # Mean rates of `row` for buckets first..last as (rx, tx) arrays, NaN
+        # where a bucket has no sample. Only the window's slots are read.
+        buckets = np.arange(first, last + 1)
+        slots = buckets % self.slots
+        count = self.count[row, slots]
+        valid = (self.bucket[slots] == buckets) & (count > 0)
+        count = np.where(valid, count, 1)
+        rx = np.where(valid, self.rx_sum[row, slots] / count, np.nan)
+        tx = np.where(valid, self.tx_sum[row, slots] / count, np.nan)
+        return rx, tx
+
+
+class SpaceSaving(object):
+    # Space-saving heavy-hitter sketch: keeps at most `capacity` keys; when full,
+    # a new key replaces the smallest one and inherits its count as error bound.
+    # The smallest key comes from a min-heap with one entry per key; entries go
+    # stale (too low) as counts grow and are corrected when they reach the top.
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.counts = {}  # key -> [count, error]
+        self.heap = []    # [(count, seq, key)]; seq keeps keys out of comparisons
+        self.seq = 0
+
+    def __len__(self):
+        return len(self.counts)
+
+    def _push(self, key, count):
+        self.seq += 1
+        heapq.heappush(self.heap, (count, self.seq, key))
+
+    def add(self, key, weight):
+        entry = self.counts.get(key)
+        if entry is not None:
+            entry[0] += weight
+            return
+        if len(self.counts) < self.capacity:
+            self.counts[key] = [weight, 0]
+            self._push(key, weight)
+            return
+        heap = self.heap
+        while True:
+            count, seq, victim = heap[0]
+            current = self.counts[victim][0]
+            if current == count:
+                break
+            self.seq += 1
+            heapq.heapreplace(heap, (current, self.seq, victim))
+        heapq.heappop(heap)
+        floor = self.counts.pop(victim)[0]
+        self.counts[key] = [floor + weight, floor]
+        self._push(key, floor + weight)
+
+    def decay(self, factor):
+        for entry in self.counts.values():
+            entry[0] *= factor
+            entry[1] *= factor
+        # Scaling every count by the same factor keeps the heap ordered
+        self.heap = [(count * factor, seq, key) for count, seq, key in self.heap]
+
+    def top(self, n):
+        # [(key, count, error)] with the largest counts first
+        items = heapq.nlargest(n, self.counts.items(), key=lambda item: item[1][0])
+        return [(key, count, error) for key, (count, error) in items]
+
+
+class FlowBatchResult(object):
+    # Completion status of flow-mod batches sent to several switches at once
+    def __init__(self, dpids, callback=None):
+        self.started = time.time()
+        self.status = dict((dpid, {'status': 'pending', 'flow_mods': 0, 'errors': []}) for dpid in dpids)
+        self.remaining = len(self.status)
+        self.callback = callback
+        self.done = hub.Event()
+        if not self.remaining:
+            self.done.set()
+
+    def finish(self, dpid, status, error=None):
+        entry = self.status[dpid]
+        if entry['status'] != 'pending':
+            return
+        if error is not None:
+            entry['errors'].append(error)
+        entry['status'] = 'error' if entry['errors'] else status
+        entry['seconds'] = time.time() - self.started
+        self.remaining -= 1
+        if not self.remaining:
+            self.done.set()
+            if self.callback is not None:
+                self.callback(self)
+
+    def wait(self, timeout):
+        # Blocks the calling greenthread; switches that have not confirmed in time are reported as 'timeout'
+        self.done.wait(timeout)
+        for entry in self.status.values():
+            if entry['status'] == 'pending':
+                entry['status'] = 'timeout'
+        return dict((str(dpid), entry) for dpid, entry in self.status.items())
+
+
+def flow_signature(cookie, instructions, idle_timeout, hard_timeout):
+    # What an ADD for an existing (table, priority, match) would change; the
+    # same for a flow-mod we build and the flow stats entry it produces. An
+    # empty APPLY_ACTIONS (drop) may be listed back as no instruction at all.
+    return (cookie, idle_timeout, hard_timeout,
+            tuple((inst.type, tuple(repr(action) for action in inst.actions)) if hasattr(inst, 'actions')
+                  else repr(inst) for inst in instructions
+                  if inst.type != ofproto_v1_3.OFPIT_APPLY_ACTIONS or inst.actions))
+
+
+class ShadowFlow(object):
+    __slots__ = ('cookie', 'instructions', 'idle_timeout', 'hard_timeout', 'flags', 'signature',
+                 'installed', 'repaired')
+
+    def __init__(self, flow, installed):
+        # `flow` is a flow-mod or a flow stats entry
+        self.cookie = flow.cookie
+        self.instructions = flow.instructions
+        self.idle_timeout = flow.idle_timeout
+        self.hard_timeout = flow.hard_timeout
+        self.flags = flow.flags
+        self.signature = flow_signature(flow.cookie, flow.instructions, flow.idle_timeout, flow.hard_timeout)
+        self.installed = installed
+        self.repaired = False
+
+
+class ShadowFlowTable(object):
+    # The flows the controller believes one switch holds, keyed by
+    # (table_id, priority, sorted match items) so that a match listed back in
+    # wire order finds the entry built from keyword arguments. An ADD identical
+    # to an entry and a strict delete of a missing key are no-ops; full flow
+    # stats replies correct the entries. Until the table has been checked against the switch after a
+    # (re)connect (`verified`) nothing is skipped.
+    def __init__(self):
+        self.entries = {}
+        self.verified = False
+        self.pending = {}  # {xid: {key: stats entry}} while a multipart reply comes in
+
+    @staticmethod
+    def key(flow):
+        # `flow` is a flow-mod, a flow stats entry or a flow-removed message
+        return flow.table_id, flow.priority, tuple(sorted(flow.match.items()))
+
+    def add(self, mod, now):
+        # False when the switch already has exactly this flow
+        key = self.key(mod)
+        entry = self.entries.get(key)
+        if entry is not None and entry.signature == flow_signature(mod.cookie, mod.instructions,
+                                                                   mod.idle_timeout, mod.hard_timeout):
+            return False
+        self.entries[key] = ShadowFlow(mod, now)
+        return True
+
+    def delete_strict(self, mod):
+        # False when there was no such flow
+        return self.entries.pop(self.key(mod), None) is not None
+
+    def delete(self, mod, ofproto):
+        # Non-strict delete: every entry whose match contains the mod's match
+        # fields and that passes its table, cookie and out_port filters
+        items = mod.match.items()
+        for key, entry in list(self.entries.items()):
+            if mod.table_id != ofproto.OFPTT_ALL and key[0] != mod.table_id:
+                continue
+            if (entry.cookie ^ mod.cookie) & mod.cookie_mask:
+                continue
+            fields = dict(key[2])
+            if any(field not in fields or fields[field] != value for field, value in items):
+                continue
+            if mod.out_port != ofproto.OFPP_ANY and not any(
+                    getattr(action, 'port', None) == mod.out_port
+                    for inst in entry.instructions for action in getattr(inst, 'actions', ())):
+                continue
+            del self.entries[key]
+
+    def removed(self, key, cookie):
+        # A flow expired on the switch
+        entry = self.entries.get(key)
+        if entry is not None and entry.cookie == cookie:
+            del self.entries[key]
+
+    def drop_metered(self, meter_id=None):
+        # Deleting a meter (None: all of them) deletes the flows using it
+        for key, entry in list(self.entries.items()):
+            for inst in entry.instructions:
+                if hasattr(inst, 'meter_id') and meter_id in (None, inst.meter_id):
+                    del self.entries[key]
+                    break
+
+    def collect(self, xid, flows):
+        listed = self.pending.setdefault(xid, {})
+        for flow in flows:
+            listed[self.key(flow)] = flow
+
+    def reconcile(self, xid, since):
+        # Bring the entries in line with the complete reply `xid` to a request
+        # sent at `since`; flow-mods sent after that are left alone. Returns the
+        # permanent entries the switch lost, each reported once: a flow that
+        # stays missing after being put back is given up on.
+        listed = self.pending.pop(xid, {})
+        lost = []
+        for key, entry in list(self.entries.items()):
+            if key in listed or entry.installed >= since:
+                continue
+            del self.entries[key]
+            if not entry.idle_timeout and not entry.hard_timeout and not entry.repaired:
+                lost.append((key, entry))
+        for key, flow in listed.items():
+            entry = self.entries.get(key)
+            if entry is None or entry.installed < since and entry.signature != flow_signature(
+                    flow.cookie, flow.instructions, flow.idle_timeout, flow.hard_timeout):
+                self.entries[key] = ShadowFlow(flow, since)
+            else:
+                entry.repaired = False
+        self.verified = True
+        return lost
+
+
+class PortState(object):
+    # Threshold state of one port, with the rate and threshold of its last sample
+    __slots__ = ('state', 'since', 'rate', 'threshold')
+
+    def __init__(self, state, since):
+        self.state = state
+        self.since = since
+        self.rate = 0.0
+        self.threshold = 0.0
+
+
+class PollState(object):
+    # Stats polling schedule and outstanding requests of one switch
+    __slots__ = ('next_port', 'next_meter', 'next_flow', 'next_fast', 'backoff', 'pending', 'keys')
+
+    def __init__(self, port_phase, flow_phase):
+        self.next_port = port_phase
+        self.next_meter = port_phase
+        self.next_flow = flow_phase
+        self.next_fast = port_phase
+        self.backoff = {}  # poll kind -> interval multiplier; 1.0 when absent
+        self.pending = {}  # xid -> (key, sent time)
+        self.keys = {}     # key -> xid; key is 'port', 'flow', 'meter' or ('hot', port_no)
+
+
+class Topology(object):
+    # Switch graph from LLDP link discovery. Shortest paths are kept as one BFS
+    # tree per destination switch, built on first use; a link change drops only
+    # the trees it can change.
+    def __init__(self):
+        self.links = {}  # {dpid: {peer dpid: (port_no, peer port_no)}}, one entry per direction
+        self.link_ports = set()  # (dpid, port_no) facing another switch
+        self.trees = {}  # {dst dpid: {dpid: (hops, next dpid, out port_no)}}
+
+    def add_link(self, src, src_port, dst, dst_port):
+        peers = self.links.setdefault(src, {})
+        old = peers.get(dst)
+        if old == (src_port, dst_port):
+            return False
+        if old is not None:
+            self.link_ports.discard((src, old[0]))
+        peers[dst] = (src_port, dst_port)
+        self.link_ports.add((src, src_port))
+        for root, tree in list(self.trees.items()):
+            # A new edge only matters to a tree it gives a shorter way into
+            if dst in tree and (src not in tree or tree[src][0] > tree[dst][0] + 1):
+                del self.trees[root]
+            elif old is not None and tree.get(src, (0, None))[1] == dst:
+                del self.trees[root]  # same neighbour, different port
+        return True
+
+    def remove_link(self, src, src_port, dst, dst_port):
+        if self.links.get(src, {}).get(dst) != (src_port, dst_port):
+            return False
+        del self.links[src][dst]
+        if not self.links[src]:
+            del self.links[src]
+        self.link_ports.discard((src, src_port))
+        for root, tree in list(self.trees.items()):
+            # Removing an edge the tree does not use leaves it a shortest-path tree
+            if root == dst or tree.get(src, (0, None))[1] == dst:
+                del self.trees[root]
+        return True
+
+    def tree(self, root):
+        tree = self.trees.get(root)
+        if tree is None:
+            incoming = {}
+            for src, peers in self.links.items():
+                for dst, (src_port, dst_port) in peers.items():
+                    incoming.setdefault(dst, []).append((src, src_port))
+            tree = {root: (0, None, None)}
+            queue = [root]
+            for node in queue:
+                hops = tree[node][0] + 1
+                for src, src_port in incoming.get(node, ()):
+                    if src not in tree:
+                        tree[src] = (hops, node, src_port)
+                        queue.append(src)
+            self.trees[root] = tree
+        return tree
+
+    def path(self, src, in_port, dst, out_port):
+        # [(dpid, in_port, out_port)] for every switch from (src, in_port) to
+        # (dst, out_port), or None when dst cannot be reached
+        tree = self.tree(dst)
+        hops = []
+        while src != dst:
+            entry = tree.get(src)
+            if entry is None:
+                return None
+            hops.append((src, in_port, entry[2]))
+            in_port = self.links[src][entry[1]][1]
+            src = entry[1]
+        hops.append((dst, in_port, out_port))
+        return hops
+
+
+class ShardRing(object):
+    # Which shard owns which switch. Owners come from rendezvous hashing over
+    # the live shards, so every shard computes the same owner from the same
+    # membership and a dead shard only hands over its own switches. Shards are
+    # presumed alive at start and declared dead after `dead_after` seconds
+    # without a message from them.
+    def __init__(self, index, count, dead_after, now):
+        self.index = index
+        self.count = count
+        self.dead_after = dead_after
+        self.last_heard = dict((shard, now) for shard in range(count))
+
+    def heard(self, shard, now):
+        self.last_heard[shard] = now
+
+    def alive(self, now):
+        return tuple(shard for shard, t in sorted(self.last_heard.items())
+                     if shard == self.index or now - t <= self.dead_after)
+
+    @staticmethod
+    def owner(dpid, alive):
+        return max(alive, key=lambda shard: hashlib.md5(b'%d:%d' % (dpid, shard)).digest())
+
+
+# LLDP link discovery for shortest-path forwarding is opt-in: set SDN_TOPOLOGY=1
+# and run ryu-manager with --observe-links. Without it every switch is handled
+# on its own (MAC learning, OFPP_FLOOD). Not available with sharding, see below.
+# The link event handlers are only registered with it on (after the class), so
+# ryu-manager does not load ryu.topology.switches otherwise.
+TOPOLOGY_ENABLED = os.environ.get('SDN_TOPOLOGY', '0') == '1'
+
 
 class SimpleSwitch13(app_manager.RyuApp):
     OFP_VERSIONS = [ofproto_v1_3.OFP_VERSION]
@@ -30,7 +1111,26 @@ class SimpleSwitch13(app_manager.RyuApp):
 
     def __init__(self, *args, **kwargs):
         super(SimpleSwitch13, self).__init__(*args, **kwargs)
-        start_http_server(8000, addr="0.0.0.0")  # Expose metrics here
+
+        # Sharded mode: SDN_SHARD_COUNT ryu-manager processes, each started with
+        # its own SDN_SHARD_INDEX, OpenFlow listen port and --wsapi-port. Every
+        # switch connects to all of them (e.g. ovs-vsctl set-controller br0
+        # tcp:127.0.0.1:6653 tcp:127.0.0.1:6654 ...); the owning shard takes the
+        # MASTER role and the others stay SLAVE. Shards talk over UDP on
+        # 127.0.0.1:SDN_SHARD_BASE_PORT+index; datagrams are only taken from a
+        # peer's port, and with SDN_SHARD_SECRET set every datagram carries an
+        # HMAC-SHA256 of its payload keyed with that secret.
+        self.shard_index = int(os.environ.get('SDN_SHARD_INDEX', 0))
+        self.shard_count = int(os.environ.get('SDN_SHARD_COUNT', 1))
+        self.shard_base_port = int(os.environ.get('SDN_SHARD_BASE_PORT', 7100))
+        self.shard_secret = os.environ.get('SDN_SHARD_SECRET', '').encode('utf-8')
+        # SLAVE shards cannot send the LLDP packet-outs and each shard would only
+        # learn the links into its own switches, so paths across shards cannot be
+        # computed: the two modes are mutually exclusive
+        if TOPOLOGY_ENABLED and self.shard_count > 1:
+            raise ValueError('SDN_TOPOLOGY=1 cannot be combined with SDN_SHARD_COUNT > 1')
+
+        start_http_server(8000 + self.shard_index, addr="0.0.0.0")  # Expose metrics here
         # Prometheus counter
         global packet_in_counter
         packet_in_counter = Counter('ryu_packet_in_total', 'Number of packet-in messages')
@@ -41,29 +1141,110 @@ class SimpleSwitch13(app_manager.RyuApp):
         
         self.connected_hosts_gauge = Gauge('ryu_connected_hosts', 'Number of connected hosts', ['dpid'])
 
+        # Packet-in admission counters
+        self.packet_in_dropped_counter = Counter('ryu_packet_in_dropped_total',
+                                                 'Packet-ins dropped by rate limiting', ['reason'])
+        self.packet_in_coalesced_counter = Counter('ryu_packet_in_coalesced_total',
+                                                   'Duplicate packet-ins coalesced while a flow was being installed')
+
+        # Stats polling
+        self.stats_poll_rtt_histogram = Histogram('ryu_stats_poll_rtt_seconds',
+                                                  'Stats request to final reply time', ['kind'],
+                                                  buckets=(.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5))
+        self.stats_poll_skipped_counter = Counter('ryu_stats_poll_skipped_total',
+                                                  'Stats polls skipped because the previous one was outstanding',
+                                                  ['kind'])
+        self.stats_poll_timeout_counter = Counter('ryu_stats_poll_timeouts_total',
+                                                  'Stats requests that got no reply in time', ['kind'])
+
+        # Handler timing, flow-mod rate and queue depths, to see where the controller saturates
+        self.packet_in_latency_histogram = Histogram('ryu_packet_in_seconds', 'Packet-in handling time',
+                                                     buckets=(.00005, .0001, .00025, .0005, .001, .0025,
+                                                              .005, .01, .025, .05, .1))
+        self.port_stats_latency_histogram = Histogram('ryu_port_stats_reply_seconds',
+                                                      'Port stats reply handling time',
+                                                      buckets=(.0001, .00025, .0005, .001, .0025, .005,
+                                                               .01, .025, .05, .1, .25))
+        self.flow_mod_counter = Counter('ryu_flow_mods_sent_total', 'Flow-mods sent', ['dpid'])
+        self.flow_mod_suppressed_counter = Counter('ryu_flow_mods_suppressed_total',
+                                                   'Flow-mods not sent because the shadow flow table '
+                                                   'showed them to be no-ops')
+        self.flow_drift_counter = Counter('ryu_flow_drift_total',
+                                          'Permanent flows found missing from a switch and sent again')
+        self.reinstall_gauge = Gauge('ryu_switch_reinstall_seconds',
+                                     'Switch connect to confirmed reinstall of saved rules', ['dpid'])
+        self.warm_restart_gauge = Gauge('ryu_warm_restart_seconds',
+                                        'Controller start until every known switch had its saved rules back')
+        self.event_queue_gauge = Gauge('ryu_event_queue_depth', 'Events waiting in the app event queue')
+        self.event_queue_gauge.set_function(self.events.qsize)
+        self.send_queue_gauge = Gauge('ryu_datapath_send_queue_depth', 'Messages waiting to be sent to a switch',
+                                      ['dpid'])
+        # Metric children cached per dpid / (dpid, port) so hot paths skip labels() and str()
+        self.flow_mod_children = {}
+        self.connected_hosts_children = {}
+        self.send_queue_children = {}
+        self.port_metric_children = {}  # {dpid: [(rx child, tx child) per PortStatsTable row]}
+
+        # Host table occupancy and evictions
+        self.host_table_entries_gauge = Gauge('ryu_host_table_entries', 'Entries in the host learning tables',
+                                              ['dpid', 'table'])
+        self.host_table_evictions_counter = Counter('ryu_host_table_evictions_total',
+                                                    'Host table entries evicted', ['table', 'reason'])
+
         self.mac_to_port = {}
         self.datapaths = {}
-        self.port_stats = {}
-        self.port_throughput = {}
+        self.port_tables = {}  # {dpid: PortStatsTable}
         self.security_priority = 100
         
-        # Load link bandwidth from file
-        self.link_bandwidth = self._load_link_bandwidth('/home/ryu/Downloads/link_bandwidth.json')
-        
-        # Initialize dynamic threshold based on bandwidth
-        self.initial_threshold = self.calculate_initial_threshold()
-        
-        self.throughput_history = {}
+        # Port thresholds: link_bandwidth.json compiled into a ThresholdPolicy,
+        # plus per-port overrides set through the REST API (persisted). The file
+        # is checked every link_bandwidth_check_interval and a changed one is
+        # compiled and swapped in whole; a broken one keeps the old policy.
+        self.link_bandwidth_path = os.environ.get('SDN_LINK_BANDWIDTH', '/home/ryu/Downloads/link_bandwidth.json')
+        self.link_bandwidth_check_interval = 2.0  # seconds
+        self.link_bandwidth_stamp = self._link_bandwidth_stamp()
+        self.link_bandwidth = self._load_link_bandwidth(self.link_bandwidth_path)
+        self.threshold_overrides = {}  # {(dpid, port_no): bytes/s}
+        try:
+            self.threshold_policy = ThresholdPolicy(self.link_bandwidth)
+        except ValueError as e:
+            self.logger.error('Invalid link bandwidth file %s: %s', self.link_bandwidth_path, e)
+            self.link_bandwidth = {}
+            self.threshold_policy = ThresholdPolicy()
+        self.link_bandwidth_thread = hub.spawn(self._watch_link_bandwidth)
+
+        # Throughput history: every rate sample also goes into one ThroughputRing
+        # per level, (resolution seconds, buckets kept) finest first, which makes
+        # the rollups as the samples arrive. Memory is fixed per port.
+        self.history_levels = ((1, 300), (10, 360), (60, 720))  # 5 min, 1 h, 12 h
+        self.throughput_history = {}  # {dpid: [ThroughputRing per level]}
+
+        # Stats polling: every switch gets its own phase within the interval plus
+        # jitter, a switch with a request still outstanding is skipped and backed
+        # off, and ports close to their threshold are polled on their own faster
+        self.poll_interval = 1.0        # seconds between full port stats polls
+        self.flow_stats_interval = 1.0  # seconds between flow stats polls
+        self.fast_poll_interval = 0.25  # seconds between polls of near-threshold ports
+        self.near_threshold_ratio = 0.8
+        self.poll_jitter = 0.1          # +/- fraction of the interval
+        self.poll_timeout = 3.0         # seconds before an outstanding request is given up
+        self.poll_max_backoff = 8.0     # cap on the interval multiplier for slow switches
+        self.poll_tick = 0.05
+        self.poll_state = {}  # {dpid: PollState}
         self.monitor_thread = hub.spawn(self._monitor)
         
-        # Dictionary to track blocked ports and their last exceeded time
-        self.blocked_ports = {}
-
-        # Dictionary to track the time throughput has stayed below threshold
-        self.below_threshold_time = {}
-
-        # Dictionary to track the time throughput has been above threshold
-        self.above_threshold_time = {}
+        # Per-port threshold state machine (PORT_* states). Stats samples move
+        # ports between states; the deadlines live in a timer wheel advanced by
+        # _monitor_tick, so they fire on time whether or not stats arrive. Ports
+        # back to normal have no entry.
+        self.port_states = {}  # {dpid: {port_no: PortState}}
+        self.port_wheel = TimerWheel(0.1, 1024, time.time())
+        self.port_transition_counter = Counter('ryu_port_state_transitions_total',
+                                               'Port threshold state transitions', ['from_state', 'to_state'])
+        self.port_transition_children = {}
+        self.port_state_gauge = Gauge('ryu_port_states', 'Ports per threshold state', ['state'])
+        self.port_state_children = dict((state, self.port_state_gauge.labels(state=state))
+                                        for state in (PORT_ABOVE, PORT_BLOCKED, PORT_UNBLOCKING, PORT_RECENT))
 
         # Timeout for unlocking a port 
         self.unlock_timeout = 10  # seconds
@@ -71,18 +1252,205 @@ class SimpleSwitch13(app_manager.RyuApp):
         # Time that throughput must stay above threshold to trigger block
         self.block_window = 5  # seconds
 
-        # Dictionary to track the last unblock time of ports
-        self.last_unblock_time = {}
+        # How port thresholds are enforced: 'block' runs the state machine above
+        # and drops a port's ICMP while it is blocked; 'meter' gives every port an
+        # OpenFlow meter at its threshold rate (meter id = port number) and
+        # attaches it to the flows learned from that port, so the switch polices
+        # the excess itself. Forwarding entries restored at reconnect match no
+        # in_port and use the meter of the port they forward to. Meters only act
+        # on flows: floods and packet-outs sent by the controller are not metered
+        # (they are bounded by the packet-in admission limits instead), and ports
+        # numbered above OFPM_MAX have no meter id and stay unmetered. Meter band
+        # stats are polled with the port stats.
+        self.enforcement_mode = 'block'
+        self.meter_burst = 0.1  # seconds of traffic at the meter rate allowed as burst
+        self.meters = {}  # {dpid: {port_no: rate in kbps}} installed on the switch
+        self.meter_in_bytes_gauge = Gauge('ryu_meter_in_bytes', 'Bytes seen by the port meter',
+                                          ['dpid', 'port'])
+        self.meter_dropped_bytes_gauge = Gauge('ryu_meter_dropped_bytes', 'Bytes dropped by the port meter band',
+                                               ['dpid', 'port'])
+        self.meter_metric_children = {}  # {(dpid, port_no): (in child, dropped child)}
+
+        # Going over threshold this soon after an automatic unblock blocks again at once
+        self.reblock_window = 1  # seconds
+
+        # Smoothing factor for the per-port EWMA rates, and whether threshold
+        # decisions use the smoothed rate instead of the raw one
+        self.ewma_alpha = 0.3
+        self.threshold_on_ewma = False
 
         # Timestamp for the last log
         self.last_log_time = time.time()
 
+        # Parse packet-in frames with parse_eth_ipv4 instead of ryu's full parser
+        self.fast_path = True
+
+        # "packet in" lines are logged at most once per interval, the rest are counted
+        self.packet_in_log_interval = 1.0  # seconds
+        self.packet_in_log_time = 0
+        self.packet_in_log_suppressed = 0
+
+        # Packet-in admission: token buckets per switch and per source MAC
+        self.switch_packet_in_rate = 1000   # packet-ins/s per switch
+        self.switch_packet_in_burst = 2000
+        self.source_packet_in_rate = 100    # packet-ins/s per source MAC
+        self.source_packet_in_burst = 200
+        self.source_bucket_limit = 4096     # source buckets kept (LRU)
+        self.switch_buckets = {}
+        self.source_buckets = OrderedDict()
+
+        # Learned flows waiting for their barrier reply: {(dpid, src, dst): (deadline, out_port)}
+        self.flows_in_flight = {}
+        self.flow_install_timeout = 1.0  # seconds
+
+        # Callbacks waiting on a barrier reply: {(dpid, xid): callback}
+        self.barrier_callbacks = {}
+
+        # Bulk flow-mods are grouped per switch and sent either as a plain batch
+        # followed by a barrier ('barrier') or inside an ONF bundle ('bundle', OVS)
+        self.flow_batch_mode = 'barrier'
+        self.flow_batch_timeout = 5.0  # seconds a REST call waits for confirmation
+        self.bundle_id = 0
+        self.batch_xids = {}  # {(dpid, xid): FlowBatchResult} for matching error replies
+
+        # Shadow flow table per switch: flow-mods it shows to be no-ops are not
+        # sent, and every full flow stats reply corrects it (lost permanent
+        # flows are sent again). Tables outlive a disconnect; a (re)connecting
+        # switch is listed first and the saved state is then diffed against it.
+        self.shadow_flows = {}  # {dpid: ShadowFlowTable}
+        self.flow_syncs = {}  # {dpid: (xid, sent time)} of the listing requested at connect
+
+        # Host aging: mac_to_port holds one HostTable per dpid. Entries
+        # not refreshed by a packet-in within host_idle_timeout expire, and learned
+        # flows carry the same idle_timeout on the switch.
+        self.host_idle_timeout = 300    # seconds
+        self.host_table_capacity = 4096  # entries per switch and table
+        self.host_last_seen = {}  # {(table, dpid, key): timestamp}
+        self.host_move_confirm = 30  # seconds; see _locate_host
+        self.aging_wheel = TimerWheel(1.0, 512, time.time())
+        self.aging_thread = hub.spawn(self._aging)
+
+        # Block list entries as shown by /blocked_ips (addresses and CIDR prefixes),
+        # the same entries in a prefix trie, and the aggregated prefixes that are
+        # actually installed as drop rules on every switch
         self.blocked_ips = set()
-
-        #Show IP Connect
-        self.hosts = set()
-
-        self.ip_to_port = {}  # Dạng: {dpid: {ip: port}}
+        self.blocked_trie = PrefixTrie()
+        self.block_rules = set()
+
+        # Ports with a block rule installed, whether blocked automatically or through the API,
+        # and ports unblocked while their switch was disconnected (rule removed on reconnect)
+        self.port_blocks = set()
+        self.pending_unblocks = set()
+
+        # Host inventory: IP, edge location and last seen of every source MAC,
+        # served by /hosts, /connected_ips and /host_to_switch. Hosts not seen
+        # for host_idle_timeout are dropped.
+        self.host_inventory_capacity = 65536
+        self.inventory = HostInventory(self.host_inventory_capacity)
+        self.hosts_gauge = Gauge('ryu_hosts', 'Hosts in the inventory')
+        self.hosts_gauge.set_function(lambda: len(self.inventory))
+
+        # Topology from LLDP link discovery and where each host attaches (in the
+        # inventory): known destinations get a flow on every switch of the
+        # shortest path at once, and once links are known broadcasts go out of
+        # edge ports only
+        self.topology = Topology()
+
+        # Cached, versioned JSON served by the REST API and pushed on /events
+        self.snapshot = StateSnapshot()
+        self.snapshot.register('blocked_ips', lambda: list(self.blocked_ips))
+        # Views each shard builds from its own switches; REST serves them merged
+        # with the peers' copies
+        self.shared_views = {
+            'connected_ips': self.inventory.ips,
+            'host_to_switch': self._host_to_switch_view,
+            'ports': self._ports_view,
+            'thresholds': self._thresholds_view,
+            'hosts': self._hosts_view,
+        }
+        for name in self.shared_views:
+            if name != 'hosts':  # paged through /hosts instead, see host_page
+                self.snapshot.register(name, lambda name=name: self._merged_view(name))
+        self.snapshot.register('topology', self._topology_view)
+        self.event_keepalive = 15  # seconds between SSE keepalive comments
+
+        # ARP proxy: requests for an IP whose MAC is known and still located are
+        # answered by the controller; unresolved ones are flooded at most once
+        # per arp_flood_interval per switch and target IP, repeats in between
+        # are dropped
+        self.arp_proxy = True
+        self.arp_flood_interval = 1.0  # seconds
+        self.arp_flood_time = HostTable(self.host_table_capacity)  # {(dpid, target ip): last flood}
+        self.arp_proxy_counter = Counter('ryu_arp_proxy_requests_total',
+                                         'ARP requests seen by the proxy', ['result'])
+        self.arp_proxy_children = dict((result, self.arp_proxy_counter.labels(result=result))
+                                       for result in ('hit', 'miss', 'suppressed'))
+
+        # Heavy hitters: learned-flow byte deltas from flow stats replies feed a
+        # space-saving sketch keyed by (dpid, in_port, eth_src). Scores decay with
+        # heavy_hitter_half_life so they track current traffic.
+        self.heavy_hitters = SpaceSaving(128)
+        self.heavy_hitter_half_life = 10.0  # seconds
+        self.heavy_hitter_decay_time = time.time()
+        self.flow_byte_counts = {}    # {dpid: {(in_port, eth_src, eth_dst): byte_count}}
+        self.flow_byte_pending = {}   # same, while a multipart reply is being received
+        # When a port stays over threshold, block its top talker's IP rather than the port
+        self.source_mitigation = False
+
+        # Persistent state: block list, port blocks, threshold timers and learned
+        # MACs survive a restart and are pushed back to each switch when it connects
+        self.start_time = time.time()
+        self.state_dir = os.environ.get('SDN_STATE_DIR', '/home/ryu/Downloads/controller_state')
+        if self.shard_count > 1:
+            self.state_dir = os.path.join(self.state_dir, 'shard-%d' % self.shard_index)
+        self.state_snapshot_interval = 30  # seconds between journal compactions
+        self.state_snapshot_time = self.start_time
+        self.restore_flow_timeout = 60  # hard timeout of restored forwarding flows
+        self.known_switches = set()
+        self.restart_pending = set()  # known switches not yet confirmed since start
+        self.journal = StateJournal(self.state_dir, self.logger)
+
+        # Shard state: every connected switch (self.datapaths holds the owned
+        # ones), the peers' copies of the shared views, and a last-writer-wins
+        # stamp (time, shard) per block list entry so concurrent changes made
+        # through different shards settle the same way everywhere
+        self.shard_datapaths = {}
+        self.shard_views = {}  # {shard: {view name: view}}
+        self.peer_hosts = None  # HostInventory of the peers' 'hosts' views, built on the next /hosts page
+        self.shard_sent_views = {}  # {view name: crc32 of the copy last sent}
+        self.shard_heartbeat = 1.0     # seconds between heartbeats
+        self.shard_dead_after = 3.5    # seconds of silence before a peer's switches are taken over
+        self.shard_view_refresh = 10   # heartbeats between full resends of the shared views
+        self.shard_tombstone_ttl = 3600  # seconds unblocked entries keep their stamp
+        self.shard_fragment_size = 48000  # bytes of JSON per datagram
+        self.shard_flood_rate = 100.0   # broadcast frames/s relayed to the peers
+        self.shard_flood_burst = 200
+        self.shard_flood_bucket = TokenBucket(self.shard_flood_rate, self.shard_flood_burst, time.time())
+        self.shard_fragments = {}  # {(shard, message id): [received time, parts]}
+        self.shard_message_id = 0
+        self.block_stamps = {}  # {block list entry: (time, shard)}
+        self.shard_ring = ShardRing(self.shard_index, self.shard_count, self.shard_dead_after, time.time())
+        self.shard_alive = self.shard_ring.alive(time.time())
+
+        self._restore_state()
+        self.journal.open()
+
+        if self.shard_count > 1:
+            self.shard_switches_gauge = Gauge('ryu_shard_switches', 'Switches this shard is MASTER for')
+            self.shard_peers_gauge = Gauge('ryu_shard_peers_alive', 'Peer shards heard from recently')
+            self.shard_flood_dropped_counter = Counter('ryu_shard_flood_dropped_total',
+                                                       'Broadcast frames not relayed to the peers (rate limit)')
+            self.shard_rejected_counter = Counter('ryu_shard_rejected_total',
+                                                  'Shard datagrams dropped for their sender or signature',
+                                                  ['reason'])
+            if not self.shard_secret:
+                self.logger.warning('SDN_SHARD_SECRET not set: shard messages are only checked by source port')
+            self.shard_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            # Room for a burst of fragments while this shard is busy (capped by net.core.rmem_max)
+            self.shard_socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4 * 1024 * 1024)
+            self.shard_socket.bind(('127.0.0.1', self.shard_base_port + self.shard_index))
+            self.shard_threads = [hub.spawn(self._shard_receive), hub.spawn(self._shard_heartbeat_loop)]
+            self.logger.info('Shard %d of %d', self.shard_index, self.shard_count)
 
          # Khởi tạo API
         wsgi = kwargs['wsgi']
@@ -96,22 +1464,116 @@ class SimpleSwitch13(app_manager.RyuApp):
             self.logger.error('Could not load link bandwidth file: %s', e)
             return {}
 
-    def calculate_initial_threshold(self):
-        # Calculate initial threshold based on the bandwidth of the first link in topology
+    def _link_bandwidth_stamp(self):
         try:
-            first_link_bandwidth = next(iter(self.link_bandwidth.values()))  # Get the bandwidth of the first link
-            first_link_bandwidth_value = next(iter(first_link_bandwidth.values()))  # Get the bandwidth value
-            initial_threshold = ((first_link_bandwidth_value / 8) * 10**6) * 0.8  # Use 80% of the bandwidth as initial threshold
-            return initial_threshold
-        except Exception as e:
-            self.logger.error('Error calculating initial threshold: %s', e)
-            return 750000  # Default value if calculation fails (0.75MBps)
+            stat = os.stat(self.link_bandwidth_path)
+        except OSError:
+            return None
+        return stat.st_mtime_ns, stat.st_size
+
+    def _watch_link_bandwidth(self):
+        while True:
+            hub.sleep(self.link_bandwidth_check_interval)
+            self._check_link_bandwidth()
+
+    def _check_link_bandwidth(self):
+        stamp = self._link_bandwidth_stamp()
+        if stamp == self.link_bandwidth_stamp:
+            return
+        self.link_bandwidth_stamp = stamp
+        if stamp is None:
+            return  # Removed (or being replaced): keep the current policy
+        try:
+            with open(self.link_bandwidth_path, 'r') as f:
+                config = json.load(f)
+            policy = ThresholdPolicy(config, self.threshold_overrides)
+        except (OSError, ValueError) as e:
+            self.logger.error('Invalid link bandwidth file %s, keeping the current thresholds: %s',
+                              self.link_bandwidth_path, e)
+            return
+        self.logger.info('Reloaded link bandwidth file %s', self.link_bandwidth_path)
+        self.link_bandwidth = config
+        self._apply_threshold_policy(policy)
+
+    def _apply_threshold_policy(self, policy):
+        # Swap in a compiled policy and push it to the stats tables and meters
+        self.threshold_policy = policy
+        for dpid, table in self.port_tables.items():
+            table.refresh_thresholds(lambda port_no, dpid=dpid: policy.threshold(dpid, port_no))
+        for dpid, meters in self.meters.items():
+            datapath = self.datapaths.get(dpid)
+            if datapath is None:
+                continue
+            for port_no, rate in list(meters.items()):
+                if self._meter_rate(dpid, port_no) != rate:
+                    self._add_meter(datapath, port_no, datapath.ofproto.OFPMC_MODIFY)
+        self.snapshot.touch('thresholds')
+
+    def set_thresholds(self, entries, forward=True):
+        # Per-port overrides from the REST API: [{switch, port, threshold}],
+        # threshold None goes back to the file's value. Returns one message per
+        # entry; rejected entries get a message starting with "Error".
+        messages = []
+        changed = []
+        for entry in entries:
+            try:
+                dpid = int(entry['switch'])
+                port_no = int(entry['port'])
+                threshold = entry['threshold']
+                threshold = None if threshold is None else float(threshold)
+            except (KeyError, TypeError, ValueError):
+                messages.append('Error: invalid entry {}'.format(json.dumps(entry)))
+                continue
+            max_threshold = self.threshold_policy.max_threshold(dpid, port_no)
+            if threshold is not None and not threshold > 0:
+                messages.append('Error: threshold of port {} on switch {} must be positive'.format(port_no, dpid))
+                continue
+            if threshold is not None and max_threshold is not None and threshold > max_threshold:
+                messages.append('Error: threshold of port {} on switch {} is above its link bandwidth '
+                                '({:.0f} bytes/s)'.format(port_no, dpid, max_threshold))
+                continue
+            if threshold is None:
+                self.threshold_overrides.pop((dpid, port_no), None)
+            else:
+                self.threshold_overrides[(dpid, port_no)] = threshold
+            self.journal.append('threshold', dpid, port_no, threshold)
+            changed.append((dpid, port_no, threshold))
+        if changed:
+            self._apply_threshold_policy(ThresholdPolicy(self.link_bandwidth, self.threshold_overrides))
+            if forward and self.shard_count > 1:
+                self._shard_broadcast({'t': 'thresholds', 'entries': [
+                    {'switch': dpid, 'port': port_no, 'threshold': threshold} for dpid, port_no, threshold in changed]})
+        for dpid, port_no, threshold in changed:
+            messages.append('Threshold of port {} on switch {} set to {:.0f} bytes/s'.format(
+                port_no, dpid, self.threshold_policy.threshold(dpid, port_no)))
+        return messages
+
+    def _thresholds_view(self):
+        # {dpid: [{port, threshold, max_threshold}]} for the ports of connected switches, in bytes/s
+        view = {}
+        for dpid, datapath in self.datapaths.items():
+            view[str(dpid)] = [{'port': port_no,
+                                'threshold': self.threshold_policy.threshold(dpid, port_no),
+                                'max_threshold': self.threshold_policy.max_threshold(dpid, port_no)}
+                               for port_no in sorted(datapath.ports) if port_no <= datapath.ofproto.OFPP_MAX]
+        return view
 
     @set_ev_cls(ofp_event.EventOFPSwitchFeatures, CONFIG_DISPATCHER)
     def switch_features_handler(self, ev):
         datapath = ev.msg.datapath
+        if self.shard_count > 1:
+            self.shard_datapaths[datapath.id] = datapath
+            if not self._shard_owns(datapath.id):
+                self._send_role(datapath, datapath.ofproto.OFPCR_ROLE_SLAVE)
+                return
+            self._send_role(datapath, datapath.ofproto.OFPCR_ROLE_MASTER)
+        self._setup_switch(datapath)
+
+    def _setup_switch(self, datapath):
         ofproto = datapath.ofproto
         parser = datapath.ofproto_parser
+        # What the switch kept is unknown until it has been listed
+        self._shadow_table(datapath.id).verified = False
 
         match = parser.OFPMatch()
         actions = [parser.OFPActionOutput(ofproto.OFPP_CONTROLLER,
@@ -119,24 +1581,218 @@ class SimpleSwitch13(app_manager.RyuApp):
         self.add_flow(datapath, 0, match, actions)
         
         self.datapaths[datapath.id] = datapath
+        self.snapshot.touch('ports')
+        self.snapshot.touch('thresholds')
+        self.snapshot.touch('topology')
+        if datapath.id not in self.known_switches:
+            self.known_switches.add(datapath.id)
+            self.journal.append('switch', datapath.id)
+        # The saved state goes out once the listing is in (or has timed out)
+        req = parser.OFPFlowStatsRequest(datapath)
+        datapath.set_xid(req)
+        self.flow_syncs[datapath.id] = (req.xid, time.time())
+        datapath.send_msg(req)
 
-    def add_flow(self, datapath, priority, match, actions, buffer_id=None):
+    def _reinstall_state(self, datapath, connected):
+        # Push the saved block rules, port blocks and learned forwarding entries
+        # to a (re)connecting switch as one confirmed batch. Restored forwarding
+        # flows match eth_dst only and expire after restore_flow_timeout, after
+        # which normal learning has taken over again. With a verified shadow
+        # table only what the switch lacks is sent, and security rules it holds
+        # that are no longer wanted are deleted.
+        dpid = datapath.id
+        ofproto = datapath.ofproto
+        parser = datapath.ofproto_parser
+        mods = [self._block_ip_mod(datapath, network) for network in sorted(self.block_rules)]
+        mods += [self._block_port_mod(datapath, port_no)
+                 for (blocked_dpid, port_no) in sorted(self.port_blocks) if blocked_dpid == dpid]
+        unblocked = sorted(port_no for (unblocked_dpid, port_no) in self.pending_unblocks if unblocked_dpid == dpid)
+        mods += [self._unblock_port_mod(datapath, port_no) for port_no in unblocked]
+        self.pending_unblocks.difference_update((dpid, port_no) for port_no in unblocked)
+        for mac, port_no in self.mac_to_port.get(dpid, {}).items():
+            mods.append(self._add_flow_mod(datapath, RESTORED_FLOW_PRIORITY, parser.OFPMatch(eth_dst=mac),
+                                           [parser.OFPActionOutput(port_no)],
+                                           idle_timeout=self.host_idle_timeout,
+                                           hard_timeout=self.restore_flow_timeout,
+                                           cookie=RESTORED_FLOW_COOKIE,
+                                           meter_id=self._port_meter(dpid, port_no)))
+        table = self._shadow_table(dpid)
+        if table.verified:
+            wanted = set(ShadowFlowTable.key(mod) for mod in mods if mod.command == ofproto.OFPFC_ADD)
+            mods += [parser.OFPFlowMod(datapath=datapath, command=ofproto.OFPFC_DELETE_STRICT,
+                                       table_id=key[0], priority=key[1], match=parser.OFPMatch(**dict(key[2])),
+                                       out_port=ofproto.OFPP_ANY, out_group=ofproto.OFPG_ANY)
+                     for key in table.entries if key[1] == self.security_priority and key not in wanted]
+        self.send_flow_batches({dpid: mods},
+                               callback=lambda result: self._reinstalled(dpid, len(mods), connected, result))
+
+    def _reinstalled(self, dpid, count, connected, result):
+        now = time.time()
+        self.reinstall_gauge.labels(dpid=str(dpid)).set(now - connected)
+        self.logger.info('Reinstalled saved rules on switch %s in %.3f s: %d of %d flow-mods needed (%s)',
+                         dpid, now - connected, result.status[dpid]['flow_mods'], count,
+                         result.status[dpid]['status'])
+        if dpid in self.restart_pending:
+            self.restart_pending.discard(dpid)
+            if not self.restart_pending:
+                self.warm_restart_gauge.set(now - self.start_time)
+                self.logger.info('Warm restart complete: all known switches restored %.3f s after start',
+                                 now - self.start_time)
+
+    def add_flow(self, datapath, priority, match, actions, buffer_id=None,
+                 idle_timeout=0, hard_timeout=0, cookie=0, meter_id=None):
+        return self._send_flow_mod(datapath, self._add_flow_mod(datapath, priority, match, actions, buffer_id,
+                                                                idle_timeout, hard_timeout, cookie, meter_id))
+
+    def _send_flow_mod(self, datapath, mod):
+        # False when the shadow table shows the switch already has this flow
+        if not self._shadow_filter(datapath, [mod]):
+            return False
+        datapath.send_msg(mod)
+        self._flow_mod_child(datapath.id).inc()
+        return True
+
+    def _shadow_table(self, dpid):
+        table = self.shadow_flows.get(dpid)
+        if table is None:
+            table = self.shadow_flows[dpid] = ShadowFlowTable()
+        return table
+
+    def _shadow_filter(self, datapath, mods):
+        # Record `mods` in the switch's shadow table and return the ones that
+        # change something. ADDs carrying a buffered packet always go out.
+        table = self._shadow_table(datapath.id)
+        ofproto = datapath.ofproto
+        now = time.time()
+        changed = []
+        for mod in mods:
+            if mod.command == ofproto.OFPFC_ADD:
+                if not table.add(mod, now) and table.verified and mod.buffer_id == ofproto.OFP_NO_BUFFER:
+                    continue
+            elif mod.command == ofproto.OFPFC_DELETE_STRICT:
+                if not table.delete_strict(mod) and table.verified:
+                    continue
+            elif mod.command == ofproto.OFPFC_DELETE:
+                table.delete(mod, ofproto)
+            changed.append(mod)
+        if len(changed) < len(mods):
+            self.flow_mod_suppressed_counter.inc(len(mods) - len(changed))
+        return changed
+
+    def _flow_mod_child(self, dpid):
+        child = self.flow_mod_children.get(dpid)
+        if child is None:
+            child = self.flow_mod_children[dpid] = self.flow_mod_counter.labels(dpid=str(dpid))
+        return child
+
+    def _add_flow_mod(self, datapath, priority, match, actions, buffer_id=None,
+                      idle_timeout=0, hard_timeout=0, cookie=0, meter_id=None):
         ofproto = datapath.ofproto
         parser = datapath.ofproto_parser
 
         inst = [parser.OFPInstructionActions(ofproto.OFPIT_APPLY_ACTIONS,
                                              actions)]
+        if meter_id is not None:
+            inst.insert(0, parser.OFPInstructionMeter(meter_id))
+        # Flows that expire report it, so the shadow flow table drops them in time
+        flags = ofproto.OFPFF_SEND_FLOW_REM if idle_timeout or hard_timeout else 0
         if buffer_id:
             mod = parser.OFPFlowMod(datapath=datapath, buffer_id=buffer_id,
                                     priority=priority, match=match,
-                                    instructions=inst)
+                                    instructions=inst, cookie=cookie, flags=flags,
+                                    idle_timeout=idle_timeout, hard_timeout=hard_timeout)
         else:
             mod = parser.OFPFlowMod(datapath=datapath, priority=priority,
-                                    match=match, instructions=inst)
-        datapath.send_msg(mod)
+                                    match=match, instructions=inst, cookie=cookie, flags=flags,
+                                    idle_timeout=idle_timeout, hard_timeout=hard_timeout)
+        return mod
+
+    def send_flow_batches(self, batches, callback=None):
+        # Send {dpid: [flow-mod, ...]} with one confirmed batch per switch. The
+        # returned FlowBatchResult completes when every switch has answered the
+        # barrier closing its batch; event handlers must use `callback` instead
+        # of waiting on it, since the barrier reply is handled on the same thread.
+        result = FlowBatchResult(batches.keys(), callback)
+        for dpid, mods in batches.items():
+            datapath = self.datapaths.get(dpid)
+            if datapath is None:
+                result.finish(dpid, 'error', 'Datapath not found')
+                continue
+            mods = self._shadow_filter(datapath, mods)
+            result.status[dpid]['flow_mods'] = len(mods)
+            if self.flow_batch_mode == 'bundle':
+                xids = self._send_bundle(datapath, mods)
+            else:
+                xids = []
+                for mod in mods:
+                    datapath.set_xid(mod)
+                    xids.append(mod.xid)
+                    datapath.send_msg(mod)
+            self._flow_mod_child(dpid).inc(len(mods))
+            for xid in xids:
+                self.batch_xids[(dpid, xid)] = result
+            self._send_barrier(datapath, lambda dpid=dpid, xids=xids: self._finish_batch(result, dpid, xids))
+        return result
+
+    def _send_bundle(self, datapath, mods):
+        # ONF bundle extension for OpenFlow 1.3: open, add every flow-mod, commit atomically
+        ofproto = datapath.ofproto
+        parser = datapath.ofproto_parser
+        self.bundle_id = (self.bundle_id + 1) & 0xffffffff
+        msgs = [parser.ONFBundleCtrlMsg(datapath, self.bundle_id, ofproto.ONF_BCT_OPEN_REQUEST,
+                                        ofproto.ONF_BF_ATOMIC, [])]
+        for mod in mods:
+            datapath.set_xid(mod)
+            add = parser.ONFBundleAddMsg(datapath, self.bundle_id, ofproto.ONF_BF_ATOMIC, mod, [])
+            add.set_xid(mod.xid)  # the bundled message and its wrapper share the xid
+            msgs.append(add)
+        msgs.append(parser.ONFBundleCtrlMsg(datapath, self.bundle_id, ofproto.ONF_BCT_COMMIT_REQUEST,
+                                            ofproto.ONF_BF_ATOMIC, []))
+        xids = []
+        for msg in msgs:
+            if msg.xid is None:
+                datapath.set_xid(msg)
+            xids.append(msg.xid)
+            datapath.send_msg(msg)
+        return xids
+
+    def _finish_batch(self, result, dpid, xids):
+        for xid in xids:
+            self.batch_xids.pop((dpid, xid), None)
+        result.finish(dpid, 'ok')
+
+    @set_ev_cls(ofp_event.EventOFPErrorMsg, MAIN_DISPATCHER)
+    def _error_msg_handler(self, ev):
+        msg = ev.msg
+        result = self.batch_xids.get((msg.datapath.id, msg.xid))
+        if result is not None:
+            result.status[msg.datapath.id]['errors'].append({'type': msg.type, 'code': msg.code})
+        if msg.type == msg.datapath.ofproto.OFPET_METER_MOD_FAILED and msg.datapath.id in self.meters:
+            # No (usable) meters on this switch: learned flows go out without them
+            self.logger.warning('Meter mod failed on switch %s (code %s): not metering its ports',
+                                msg.datapath.id, msg.code)
+            del self.meters[msg.datapath.id]
+
+    def _delete_learned_flows(self, datapath, mac):
+        # Remove the learned and restored flows forwarding to `mac`, leaving security rules alone
+        ofproto = datapath.ofproto
+        parser = datapath.ofproto_parser
+        mod = parser.OFPFlowMod(datapath=datapath, command=ofproto.OFPFC_DELETE,
+                                table_id=ofproto.OFPTT_ALL,
+                                cookie=LEARNED_FLOW_COOKIE, cookie_mask=FORWARDING_COOKIE_MASK,
+                                out_port=ofproto.OFPP_ANY, out_group=ofproto.OFPG_ANY,
+                                match=parser.OFPMatch(eth_dst=mac))
+        self._send_flow_mod(datapath, mod)
 
     @set_ev_cls(ofp_event.EventOFPPacketIn, MAIN_DISPATCHER)
     def _packet_in_handler(self, ev):
+        start = time.perf_counter()
+        try:
+            self._handle_packet_in(ev)
+        finally:
+            self.packet_in_latency_histogram.observe(time.perf_counter() - start)
+
+    def _handle_packet_in(self, ev):
         packet_in_counter.inc()
         if ev.msg.msg_len < ev.msg.total_len:
             self.logger.debug("packet truncated: only %s of %s bytes",
@@ -146,209 +1802,1097 @@ class SimpleSwitch13(app_manager.RyuApp):
         ofproto = datapath.ofproto
         parser = datapath.ofproto_parser
         in_port = msg.match['in_port']
+        dpid = datapath.id
+        now = time.time()
 
-        pkt = packet.Packet(msg.data)
-        eth = pkt.get_protocols(ethernet.ethernet)[0]
+        if not self._admit_switch(dpid, now):
+            return
 
-        if eth.ethertype == ether_types.ETH_TYPE_LLDP:
+        fields = self._parse_packet_in(msg.data)
+        if fields is None:
             return
-        
-        dpid = datapath.id
+        dst, src, ethertype, src_ip = fields
 
-        ip_pkt = pkt.get_protocol(ipv4.ipv4)
-        if ip_pkt:
-            src_ip = ip_pkt.src
-            
-            # Khởi tạo ip_to_port cho dpid nếu chưa tồn tại
-            self.ip_to_port.setdefault(dpid, {})
-            
-            # Kiểm tra xem IP đã tồn tại hay chưa
-            if src_ip in self.ip_to_port[dpid]:
-                existing_port = self.ip_to_port[dpid][src_ip]
-                # Nếu IP đã tồn tại nhưng trên cổng khác, cập nhật cổng mới
-                if existing_port != in_port:
-                    self.logger.warning(
-                        "IP %s moved from port %s to port %s on switch %s",
-                        src_ip, existing_port, in_port, dpid
-                    )
-            else:
-                # Nếu IP chưa tồn tại, thêm mới
-                self.logger.info("IP %s connected to switch %s at port %s", src_ip, dpid, in_port)
-            
-            # Cập nhật cổng cho IP
-            self.ip_to_port[dpid][src_ip] = in_port
+        if ethertype == ether_types.ETH_TYPE_LLDP:
+            return
 
-        dst = eth.dst
-        src = eth.src
+        if not self._admit_source(src, now):
+            return
 
-        
-        self.mac_to_port.setdefault(dpid, {})
+        arp_fields = None
+        if ethertype == ether_types.ETH_TYPE_ARP:
+            arp_fields = parse_arp(msg.data)
+            if arp_fields is not None and arp_fields[1] == src and arp_fields[2] != '0.0.0.0':
+                src_ip = arp_fields[2]  # ARP senders are learned like IPv4 sources
+
+        # The flow for this pair is already on its way to the switch: forward
+        # the packet without learning or sending another flow-mod
+        flow_key = (dpid, src, dst)
+        in_flight = self.flows_in_flight.get(flow_key)
+        if in_flight is not None and in_flight[0] > now:
+            self.packet_in_coalesced_counter.inc()
+            self._packet_out(datapath, msg, in_port, [parser.OFPActionOutput(in_flight[1])])
+            return
+
+        evicted = self.inventory.touch(src, now)
+        if evicted is not None:
+            self.host_table_evictions_counter.labels(table='inventory', reason='capacity').inc()
+            self._hosts_changed()
+        if src_ip and self.inventory.set_ip(src, src_ip):
+            self.logger.info("IP %s connected to switch %s at port %s", src_ip, dpid, in_port)
+            self._hosts_changed()
 
-        self.logger.info("packet in %s %s %s %s", dpid, src, dst, in_port)
+        mac_table = self._host_table(self.mac_to_port, dpid)
 
-        self.mac_to_port[dpid][src] = in_port
+        self._log_packet_in(dpid, src, dst, in_port)
+
+        if mac_table.get(src, in_port) != in_port:
+            # The host moved: flows still pointing at its old port are stale
+            self._delete_learned_flows(datapath, src)
+        self._learn_host('mac', mac_table, dpid, src, in_port, now)
+        if (dpid, in_port) not in self.topology.link_ports:
+            self._locate_host(src, dpid, in_port, now)
 
         connected_host_count = len(self.mac_to_port[dpid])
-        self.connected_hosts_gauge.labels(dpid=str(dpid)).set(connected_host_count)
+        hosts_child = self.connected_hosts_children.get(dpid)
+        if hosts_child is None:
+            hosts_child = self.connected_hosts_children[dpid] = self.connected_hosts_gauge.labels(dpid=str(dpid))
+        hosts_child.set(connected_host_count)
 
+        if arp_fields is not None and arp_fields[0] == arp.ARP_REQUEST and self.arp_proxy:
+            if self._proxy_arp(datapath, msg, in_port, arp_fields, now):
+                return
 
-        if dst in self.mac_to_port[dpid]:
-            out_port = self.mac_to_port[dpid][dst]
-        else:
-            out_port = ofproto.OFPP_FLOOD
+        hops = self._route(dpid, in_port, dst)
+        if hops is None:
+            if self.topology.links:
+                self._flood_edges(datapath, msg, in_port)
+                return
+            self._packet_out(datapath, msg, in_port, [parser.OFPActionOutput(ofproto.OFPP_FLOOD)])
+            return
 
+        # Downstream switches first, so the packet finds its flow on each hop
+        for hop_dpid, hop_in_port, hop_out_port in reversed(hops[1:]):
+            hop_datapath = self.datapaths.get(hop_dpid)
+            if hop_datapath is None:
+                continue  # Not ours (sharded) or gone: that switch asks for itself
+            hop_parser = hop_datapath.ofproto_parser
+            if self.add_flow(hop_datapath, LEARNED_FLOW_PRIORITY, hop_parser.OFPMatch(in_port=hop_in_port, eth_dst=dst, eth_src=src),
+                             [hop_parser.OFPActionOutput(hop_out_port)],
+                             idle_timeout=self.host_idle_timeout, cookie=LEARNED_FLOW_COOKIE,
+                             meter_id=self._port_meter(hop_dpid, hop_in_port)):
+                self._mark_in_flight(hop_datapath, (hop_dpid, src, dst), hop_out_port, now)
+
+        out_port = hops[0][2]
         actions = [parser.OFPActionOutput(out_port)]
-
-        if out_port != ofproto.OFPP_FLOOD:
-            match = parser.OFPMatch(in_port=in_port, eth_dst=dst, eth_src=src)
-            if msg.buffer_id != ofproto.OFP_NO_BUFFER:
-                self.add_flow(datapath, 1, match, actions, msg.buffer_id)
+        match = parser.OFPMatch(in_port=in_port, eth_dst=dst, eth_src=src)
+        meter_id = self._port_meter(dpid, in_port)
+        # A flow-mod the shadow table suppressed needs no barrier: the flow is
+        # already installed and the next packet will hit it
+        if msg.buffer_id != ofproto.OFP_NO_BUFFER:
+            if self.add_flow(datapath, LEARNED_FLOW_PRIORITY, match, actions, msg.buffer_id,
+                             idle_timeout=self.host_idle_timeout, cookie=LEARNED_FLOW_COOKIE, meter_id=meter_id):
+                self._mark_in_flight(datapath, flow_key, out_port, now)
+            return
+        if self.add_flow(datapath, LEARNED_FLOW_PRIORITY, match, actions,
+                         idle_timeout=self.host_idle_timeout, cookie=LEARNED_FLOW_COOKIE, meter_id=meter_id):
+            self._mark_in_flight(datapath, flow_key, out_port, now)
+        self._packet_out(datapath, msg, in_port, actions)
+
+    def _proxy_arp(self, datapath, msg, in_port, arp_fields, now):
+        # True when the request was answered or suppressed, False to flood it
+        opcode, sender_mac, sender_ip, target_ip = arp_fields
+        if target_ip == sender_ip:
+            return False  # Gratuitous ARP: let the other hosts update their caches
+        target_mac = self.inventory.mac_for(target_ip)
+        if target_mac is not None and self.inventory.location(target_mac) is not None:
+            self.arp_proxy_children['hit'].inc()
+            ofproto = datapath.ofproto
+            parser = datapath.ofproto_parser
+            datapath.send_msg(parser.OFPPacketOut(
+                datapath=datapath, buffer_id=ofproto.OFP_NO_BUFFER, in_port=ofproto.OFPP_CONTROLLER,
+                actions=[parser.OFPActionOutput(in_port)],
+                data=build_arp_reply(target_mac, target_ip, sender_mac, sender_ip)))
+            self._release_buffer(datapath, msg, in_port)
+            return True
+        # Keyed per switch too: without link discovery a flooded request reaches
+        # the next switch as its own packet-in and must be flooded there as well
+        flood_key = (datapath.id, target_ip)
+        if now - self.arp_flood_time.get(flood_key, 0) < self.arp_flood_interval:
+            self.arp_proxy_children['suppressed'].inc()
+            self._release_buffer(datapath, msg, in_port)
+            return True
+        self.arp_proxy_children['miss'].inc()
+        self.arp_flood_time.learn(flood_key, now)
+        return False
+
+    def _release_buffer(self, datapath, msg, in_port):
+        # A packet-out without actions drops a packet the switch buffered
+        if msg.buffer_id != datapath.ofproto.OFP_NO_BUFFER:
+            self._packet_out(datapath, msg, in_port, [])
+
+    def _route(self, dpid, in_port, dst):
+        # [(dpid, in_port, out_port)] from this switch to dst, or None to flood.
+        # Without a path (no links discovered, or dst unreachable) the switch's
+        # own learning table decides, as before.
+        location = self.inventory.location(dst)
+        if location is not None:
+            hops = self.topology.path(dpid, in_port, location[0], location[1])
+            if hops is not None:
+                return hops
+        out_port = self.mac_to_port[dpid].get(dst)
+        if out_port is None:
+            return None
+        return [(dpid, in_port, out_port)]
+
+    def _locate_host(self, mac, dpid, port_no, now):
+        location = self.inventory.location(mac)
+        if location == (dpid, port_no):
+            return
+        if location is not None and location[0] != dpid and not self.topology.links:
+            # Without links a host is "seen" on every switch it crosses. It only
+            # moves to another switch once its current switch has stopped seeing
+            # it for host_move_confirm, so multi-hop traffic cannot flap it.
+            seen = self.host_last_seen.get(('mac', location[0], mac))
+            if seen is not None and now - seen < self.host_move_confirm:
                 return
+        old = self.inventory.locate(mac, dpid, port_no)
+        if old is not None:
+            self.logger.warning('Host %s (%s) moved from port %s on switch %s to port %s on switch %s',
+                                mac, self.inventory.ip_of(mac), old[1], old[0], port_no, dpid)
+        if old is not None and self.topology.links:
+            # Moved to another edge port: paths towards it are stale on every switch
+            for datapath in self.datapaths.values():
+                if datapath.id != dpid:
+                    self._delete_learned_flows(datapath, mac)
+        self._hosts_changed()
+
+    def _hosts_changed(self):
+        self.snapshot.touch('connected_ips')
+        self.snapshot.touch('host_to_switch')
+        self.snapshot.touch('topology')
+
+    def _host_to_switch_view(self):
+        # Located hosts with an IP, as the dashboard lists them; the MAC lets
+        # the merged view list a host seen by several shards once
+        return [{'mac': mac, 'ip': host.ip, 'switch': str(host.dpid), 'port': host.port_no}
+                for mac, host in self.inventory.hosts.items() if host.ip is not None and host.dpid is not None]
+
+    def _hosts_view(self):
+        # Every host, for the peers' /hosts. last_seen is rounded to the full
+        # resend period so that refreshes alone do not resend the view every heartbeat.
+        period = self.shard_heartbeat * self.shard_view_refresh
+        return [{'mac': mac, 'ip': host.ip, 'dpid': host.dpid, 'port': host.port_no,
+                 'last_seen': host.last_seen - host.last_seen % period}
+                for mac, host in self.inventory.hosts.items()]
+
+    def _peer_inventory(self):
+        if self.peer_hosts is None:
+            self.peer_hosts = HostInventory(float('inf'))
+            for views in self.shard_views.values():
+                for item in views.get('hosts', ()):
+                    mac = item['mac']
+                    if mac in self.peer_hosts.hosts:
+                        continue
+                    self.peer_hosts.touch(mac, item['last_seen'])
+                    if item['ip'] is not None:
+                        self.peer_hosts.set_ip(mac, item['ip'])
+                    if item['dpid'] is not None:
+                        self.peer_hosts.locate(mac, item['dpid'], item['port'])
+        return self.peer_hosts
+
+    def host_page(self, offset, limit, dpid=None, port_no=None, network=None):
+        # Hosts ordered by IP, then the ones without an IP by MAC. The sorted
+        # indexes make a page a slice; in sharded mode the peers' hosts are
+        # merged in from the cursor, our own entry first for a MAC both have.
+        order, start, end = self.inventory.select(dpid, port_no, network)
+        total = end - start
+        if not self.shard_views:
+            keys = order[start + offset:min(end, start + offset + limit)]
+        else:
+            peers = self._peer_inventory()
+            peer_order, peer_start, peer_end = peers.select(dpid, port_no, network)
+            peer_keys = [key for key in peer_order[peer_start:peer_end] if key[3] not in self.inventory.hosts]
+            total += len(peer_keys)
+            keys = itertools.islice(heapq.merge(itertools.islice(order, start, end), peer_keys),
+                                    offset, offset + limit)
+        hosts = []
+        for key in keys:
+            mac = key[3]
+            host = self.inventory.hosts.get(mac) or peers.hosts[mac]
+            hosts.append({'mac': mac, 'ip': host.ip, 'dpid': host.dpid, 'port': host.port_no,
+                          'last_seen': host.last_seen})
+        return {'total': total, 'offset': offset, 'limit': limit, 'hosts': hosts}
+
+    def _edge_ports(self, datapath):
+        ofproto = datapath.ofproto
+        return [port_no for port_no in datapath.ports
+                if port_no <= ofproto.OFPP_MAX and (datapath.id, port_no) not in self.topology.link_ports]
+
+    def _flood_edges(self, datapath, msg, in_port):
+        # Loop-free flood: the controller sends the packet out of every edge port
+        # of every switch, and never over links. A copy arriving on a link port
+        # is one the switches forwarded already.
+        if (datapath.id, in_port) in self.topology.link_ports:
+            return
+        parser = datapath.ofproto_parser
+        actions = [parser.OFPActionOutput(port_no) for port_no in self._edge_ports(datapath) if port_no != in_port]
+        if actions:
+            self._packet_out(datapath, msg, in_port, actions)
+        else:
+            self._release_buffer(datapath, msg, in_port)
+        self._flood_data(msg.data, datapath.id)
+        if self.shard_count > 1:
+            # One datagram per peer per broadcast: an ARP storm must not turn into an IPC storm
+            if self.shard_flood_bucket.consume(time.time()):
+                self._shard_broadcast({'t': 'flood', 'data': msg.data.hex()})
             else:
-                self.add_flow(datapath, 1, match, actions)
+                self.shard_flood_dropped_counter.inc()
+
+    def _flood_data(self, data, skip_dpid=None):
+        for dpid, datapath in self.datapaths.items():
+            if dpid == skip_dpid:
+                continue
+            ofproto = datapath.ofproto
+            parser = datapath.ofproto_parser
+            actions = [parser.OFPActionOutput(port_no) for port_no in self._edge_ports(datapath)]
+            if actions:
+                datapath.send_msg(parser.OFPPacketOut(datapath=datapath, buffer_id=ofproto.OFP_NO_BUFFER,
+                                                      in_port=ofproto.OFPP_CONTROLLER, actions=actions,
+                                                      data=data))
+
+    def _packet_out(self, datapath, msg, in_port, actions):
         data = None
-        if msg.buffer_id == ofproto.OFP_NO_BUFFER:
+        if msg.buffer_id == datapath.ofproto.OFP_NO_BUFFER:
             data = msg.data
 
-        out = parser.OFPPacketOut(datapath=datapath, buffer_id=msg.buffer_id,
-                                  in_port=in_port, actions=actions, data=data)
+        out = datapath.ofproto_parser.OFPPacketOut(datapath=datapath, buffer_id=msg.buffer_id,
+                                                   in_port=in_port, actions=actions, data=data)
         datapath.send_msg(out)
 
+    def _admit_switch(self, dpid, now):
+        bucket = self.switch_buckets.get(dpid)
+        if bucket is None:
+            bucket = TokenBucket(self.switch_packet_in_rate, self.switch_packet_in_burst, now)
+            self.switch_buckets[dpid] = bucket
+        if bucket.consume(now):
+            return True
+        self.packet_in_dropped_counter.labels(reason='switch').inc()
+        return False
+
+    def _admit_source(self, src, now):
+        bucket = self.source_buckets.get(src)
+        if bucket is None:
+            bucket = TokenBucket(self.source_packet_in_rate, self.source_packet_in_burst, now)
+            self.source_buckets[src] = bucket
+            if len(self.source_buckets) > self.source_bucket_limit:
+                self.source_buckets.popitem(last=False)
+        else:
+            self.source_buckets.move_to_end(src)
+        if bucket.consume(now):
+            return True
+        self.packet_in_dropped_counter.labels(reason='source').inc()
+        return False
+
+    def _mark_in_flight(self, datapath, flow_key, out_port, now):
+        # Duplicates of this packet-in are coalesced until the switch confirms the flow
+        self.flows_in_flight[flow_key] = (now + self.flow_install_timeout, out_port)
+        self._send_barrier(datapath, lambda: self.flows_in_flight.pop(flow_key, None))
+
+    def _expire_in_flight(self, now):
+        # Drop entries whose barrier reply never came back
+        expired = [key for key, (deadline, out_port) in self.flows_in_flight.items() if deadline <= now]
+        for key in expired:
+            del self.flows_in_flight[key]
+
+    def _send_barrier(self, datapath, callback):
+        req = datapath.ofproto_parser.OFPBarrierRequest(datapath)
+        datapath.set_xid(req)
+        self.barrier_callbacks[(datapath.id, req.xid)] = callback
+        datapath.send_msg(req)
+
+    @set_ev_cls(ofp_event.EventOFPBarrierReply, [CONFIG_DISPATCHER, MAIN_DISPATCHER])
+    def _barrier_reply_handler(self, ev):
+        callback = self.barrier_callbacks.pop((ev.msg.datapath.id, ev.msg.xid), None)
+        if callback is not None:
+            callback()
+
+    def _host_table(self, tables, dpid):
+        table = tables.get(dpid)
+        if table is None:
+            table = tables[dpid] = HostTable(self.host_table_capacity)
+        return table
+
+    def _learn_host(self, name, table, dpid, key, value, now):
+        aging_key = (name, dpid, key)
+        if key not in table:
+            self.aging_wheel.schedule(aging_key, now + self.host_idle_timeout)
+        self.host_last_seen[aging_key] = now
+        if name == 'mac' and table.get(key) != value:
+            self.journal.append('learn', dpid, key, value, now)
+        evicted = table.learn(key, value)
+        if evicted is not None:
+            self._evict_host(name, dpid, evicted[0], 'capacity')
+
+    def _evict_host(self, name, dpid, key, reason):
+        # Drop the table entry and, for MACs, the flows that forward to it
+        aging_key = (name, dpid, key)
+        self.aging_wheel.cancel(aging_key)
+        self.host_last_seen.pop(aging_key, None)
+        self.mac_to_port.get(dpid, {}).pop(key, None)
+        self.journal.append('forget', dpid, key)
+        location = self.inventory.location(key)
+        if location is not None and location[0] == dpid:
+            self.inventory.locate(key, None, None)
+            self._hosts_changed()
+        datapath = self.datapaths.get(dpid)
+        if datapath is not None:
+            self._delete_learned_flows(datapath, key)
+        self.host_table_evictions_counter.labels(table=name, reason=reason).inc()
+
+    def _aging(self):
+        while True:
+            hub.sleep(self.aging_wheel.tick)
+            self._aging_tick(time.time())
+
+    def _aging_tick(self, now):
+        for aging_key in self.aging_wheel.advance(now):
+            last_seen = self.host_last_seen.get(aging_key)
+            if last_seen is None:
+                continue
+            if now - last_seen < self.host_idle_timeout:
+                # Refreshed since it was scheduled: check again later
+                self.aging_wheel.schedule(aging_key, last_seen + self.host_idle_timeout)
+            else:
+                self._evict_host(aging_key[0], aging_key[1], aging_key[2], 'idle')
+        for dpid, table in self.mac_to_port.items():
+            self.host_table_entries_gauge.labels(dpid=str(dpid), table='mac').set(len(table))
+        if self.inventory.expire(now - self.host_idle_timeout):
+            self._hosts_changed()
+
+        if now - self.state_snapshot_time >= self.state_snapshot_interval:
+            self.journal.compact(self._state_snapshot())
+            self.state_snapshot_time = now
+        else:
+            self.journal.flush()
+
+    def _state_snapshot(self):
+        return {
+            'saved': time.time(),
+            'switches': sorted(self.known_switches),
+            'blocked_ips': sorted(self.blocked_ips),
+            'port_blocks': sorted(self.port_blocks),
+            'port_states': [[dpid, port_no, entry.state, entry.since]
+                            for dpid, ports in self.port_states.items() for port_no, entry in ports.items()],
+            'hosts': [[dpid, mac, port_no, self.host_last_seen.get(('mac', dpid, mac), 0)]
+                      for dpid, table in self.mac_to_port.items() for mac, port_no in table.items()],
+            'threshold_overrides': [[dpid, port_no, threshold]
+                                    for (dpid, port_no), threshold in sorted(self.threshold_overrides.items())],
+        }
+
+    def _restore_state(self):
+        snapshot, records = self.journal.load()
+        self.known_switches.update(snapshot.get('switches', []))
+        blocked = set(snapshot.get('blocked_ips', []))
+        self.port_blocks.update((dpid, port_no) for dpid, port_no in snapshot.get('port_blocks', []))
+        # Shift port state timestamps past the downtime so each entry keeps the time it had left
+        # at shutdown instead of expiring on the first wheel tick
+        restored = time.time()
+        downtime = max(0.0, restored - snapshot.get('saved', restored))
+        for dpid, port_no, state, since in snapshot.get('port_states', []):
+            self._port_transition(dpid, port_no, state, min(since + downtime, restored))
+        hosts = dict(((dpid, mac), (port_no, last_seen)) for dpid, mac, port_no, last_seen in snapshot.get('hosts', []))
+        self.threshold_overrides.update(((dpid, port_no), threshold)
+                                        for dpid, port_no, threshold in snapshot.get('threshold_overrides', []))
+
+        for record in records:
+            op = record[0]
+            if op == 'switch':
+                self.known_switches.add(record[1])
+            elif op == 'block':
+                blocked.add(record[1])
+            elif op == 'unblock':
+                blocked.discard(record[1])
+            elif op == 'port_block':
+                self.port_blocks.add((record[1], record[2]))
+            elif op == 'port_unblock':
+                self.port_blocks.discard((record[1], record[2]))
+            elif op == 'learn':
+                hosts[(record[1], record[2])] = (record[3], record[4])
+            elif op == 'forget':
+                hosts.pop((record[1], record[2]), None)
+            elif op == 'threshold':
+                if record[3] is None:
+                    self.threshold_overrides.pop((record[1], record[2]), None)
+                else:
+                    self.threshold_overrides[(record[1], record[2])] = record[3]
+
+        for entry in blocked:
+            try:
+                network = parse_block_entry(entry)
+            except ValueError as e:
+                self.logger.warning('Skipping unreadable block list entry %r: %s', entry, e)
+                continue
+            self.blocked_ips.add(block_entry_key(network))
+            self.blocked_trie.insert(network)
+        # Installed on each switch as it connects
+        self.block_rules = set(ipaddress.collapse_addresses(self.blocked_trie.networks()))
+
+        now = time.time()
+        for (dpid, mac), (port_no, last_seen) in sorted(hosts.items(), key=lambda item: item[1][1]):
+            if now - last_seen < self.host_idle_timeout:
+                self._learn_host('mac', self._host_table(self.mac_to_port, dpid), dpid, mac, port_no, last_seen)
+
+        if self.threshold_overrides:
+            self.threshold_policy = ThresholdPolicy(self.link_bandwidth, self.threshold_overrides)
+
+        self.restart_pending = set(self.known_switches)
+        self.journal.pending = []
+        if self.known_switches or blocked:
+            self.logger.info('Restored state: %d switches, %d block entries, %d port blocks, %d hosts',
+                             len(self.known_switches), len(self.blocked_ips), len(self.port_blocks),
+                             sum(len(table) for table in self.mac_to_port.values()))
+
+    def _parse_packet_in(self, data):
+        if self.fast_path:
+            return parse_eth_ipv4(data)
+        return parse_packet(data)
+
+    def _log_packet_in(self, dpid, src, dst, in_port):
+        # Per-packet INFO logging is rate-limited so ARP storms don't stall the handler
+        now = time.time()
+        if now - self.packet_in_log_time < self.packet_in_log_interval:
+            self.packet_in_log_suppressed += 1
+            return
+        self.logger.info("packet in %s %s %s %s (%d suppressed)",
+                         dpid, src, dst, in_port, self.packet_in_log_suppressed)
+        self.packet_in_log_time = now
+        self.packet_in_log_suppressed = 0
+
     @set_ev_cls(ofp_event.EventOFPStateChange,
                 [MAIN_DISPATCHER, DEAD_DISPATCHER])
     def _state_change_handler(self, ev):
         datapath = ev.datapath
         if ev.state == MAIN_DISPATCHER:
-            if datapath.id not in self.datapaths:
+            if datapath.id not in self.datapaths and self._shard_owns(datapath.id):
                 self.logger.info('register datapath: %016x', datapath.id)
                 self.datapaths[datapath.id] = datapath
+            if datapath.id in self.datapaths and self.enforcement_mode == 'meter':
+                # Only now is the port list of the switch known
+                self._install_meters(datapath)
+            self.snapshot.touch('ports')
+            self.snapshot.touch('thresholds')
         elif ev.state == DEAD_DISPATCHER:
+            if self.shard_datapaths.get(datapath.id) is datapath:
+                del self.shard_datapaths[datapath.id]
             if datapath.id in self.datapaths:
                 self.logger.info('unregister datapath: %016x', datapath.id)
                 del self.datapaths[datapath.id]
+            self._forget_datapath(datapath.id)
+
+    def _forget_datapath(self, dpid):
+        # Barrier replies will never arrive from a dead (or released) switch
+        for key in [key for key in self.barrier_callbacks if key[0] == dpid]:
+            del self.barrier_callbacks[key]
+        for key in [key for key in self.flows_in_flight if key[0] == dpid]:
+            del self.flows_in_flight[key]
+        self.switch_buckets.pop(dpid, None)
+        self.poll_state.pop(dpid, None)
+        self.meters.pop(dpid, None)
+        self.flow_syncs.pop(dpid, None)
+        self.flow_byte_counts.pop(dpid, None)
+        self.flow_byte_pending.pop(dpid, None)
+        if dpid in self.shadow_flows:
+            self.shadow_flows[dpid].verified = False
+        self.snapshot.touch('ports')
+        self.snapshot.touch('thresholds')
+        self.snapshot.touch('topology')
+
+    @set_ev_cls(ofp_event.EventOFPPortStatus, MAIN_DISPATCHER)
+    def _port_status_handler(self, ev):
+        msg = ev.msg
+        datapath = msg.datapath
+        ofproto = datapath.ofproto
+        port_no = msg.desc.port_no
+        meters = self.meters.get(datapath.id)
+        if meters is not None and port_no <= ofproto.OFPM_MAX:
+            if msg.reason == ofproto.OFPPR_ADD and port_no not in meters:
+                self._add_meter(datapath, port_no)
+            elif msg.reason == ofproto.OFPPR_DELETE and port_no in meters:
+                datapath.send_msg(datapath.ofproto_parser.OFPMeterMod(datapath, ofproto.OFPMC_DELETE,
+                                                                      meter_id=port_no))
+                self._shadow_table(datapath.id).drop_metered(port_no)
+                del meters[port_no]
+        self.snapshot.touch('ports')
+        self.snapshot.touch('thresholds')
+
+    def _ports_view(self):
+        # Trả về danh sách tất cả các cổng và cổng bị chặn trên tất cả switch
+        ports_info = {}
+        for dpid, datapath in self.datapaths.items():
+            # Lấy danh sách mô tả các cổng từ switch
+            port_list = []
+            for port_no, port_desc in datapath.ports.items():
+                port_list.append({
+                    "port_no": port_no,
+                    "name": port_desc.name.decode('utf-8'),
+                    "hw_addr": port_desc.hw_addr
+                })
+
+            # Thêm thông tin vào kết quả trả về
+            ports_info[str(dpid)] = {
+                "all_ports": port_list,
+                "blocked_ports": sorted(port_no for (blocked_dpid, port_no) in self.port_blocks
+                                        if blocked_dpid == dpid)
+            }
+        return ports_info
+
+    # Link event handlers; registered for EventLinkAdd/EventLinkDelete below the
+    # class when SDN_TOPOLOGY=1
+    def _link_add_handler(self, ev):
+        src, dst = ev.link.src, ev.link.dst
+        if not self.topology.add_link(src.dpid, src.port_no, dst.dpid, dst.port_no):
+            return
+        self.logger.info('Link %s:%s -> %s:%s up', src.dpid, src.port_no, dst.dpid, dst.port_no)
+        # Hosts seen on what turned out to be a link port were seen through another switch
+        for mac in self.inventory.macs_on(src.dpid, src.port_no):
+            self.inventory.locate(mac, None, None)
+        self._hosts_changed()
+
+    def _link_delete_handler(self, ev):
+        src, dst = ev.link.src, ev.link.dst
+        if not self.topology.remove_link(src.dpid, src.port_no, dst.dpid, dst.port_no):
+            return
+        self.logger.info('Link %s:%s -> %s:%s down', src.dpid, src.port_no, dst.dpid, dst.port_no)
+        # Learned flows out of the dead link are removed; traffic reaching that
+        # switch misses and gets a new path from there
+        datapath = self.datapaths.get(src.dpid)
+        if datapath is not None:
+            ofproto = datapath.ofproto
+            self._send_flow_mod(datapath, datapath.ofproto_parser.OFPFlowMod(
+                datapath=datapath, command=ofproto.OFPFC_DELETE, out_port=src.port_no,
+                out_group=ofproto.OFPG_ANY, cookie=LEARNED_FLOW_COOKIE, cookie_mask=FORWARDING_COOKIE_MASK))
+        self.snapshot.touch('topology')
+
+    def _topology_view(self):
+        # Shape expected by the dashboard's topology page
+        return {
+            'switches': [{'dpid': dpid} for dpid in sorted(self.datapaths)],
+            'links': [{'src': src, 'dst': dst, 'src_port': src_port, 'dst_port': dst_port}
+                      for src, peers in sorted(self.topology.links.items())
+                      for dst, (src_port, dst_port) in sorted(peers.items())],
+            'hosts': [{'mac': mac, 'ip': host.ip, 'dpid': host.dpid, 'port': host.port_no}
+                      for mac, host in sorted(self.inventory.hosts.items()) if host.dpid is not None],
+        }
 
     def _monitor(self):
         while True:
-            for dp in self.datapaths.values():
-                self._request_stats(dp)
-            hub.sleep(1)  # Check throughput every second
-
-    def _request_stats(self, datapath):
-        self.logger.debug('send stats request: %016x', datapath.id)
+            self._monitor_tick(time.time())
+            hub.sleep(self.poll_tick)
+
+    def _monitor_tick(self, now):
+        for dpid, dp in list(self.datapaths.items()):
+            state = self.poll_state.get(dpid)
+            if state is None:
+                state = self.poll_state[dpid] = PollState(now + random.random() * self.poll_interval,
+                                                          now + random.random() * self.flow_stats_interval)
+            self._expire_polls(state, now)
+
+            if now >= state.next_port:
+                send_q = getattr(dp, 'send_q', None)
+                if send_q is not None:
+                    queue_child = self.send_queue_children.get(dpid)
+                    if queue_child is None:
+                        queue_child = self.send_queue_children[dpid] = self.send_queue_gauge.labels(dpid=str(dpid))
+                    queue_child.set(send_q.qsize())
+                if not self._poll(dp, state, 'port', now):
+                    self._back_off(state, 'port')
+                state.next_port = self._next_poll(now, self.poll_interval * state.backoff.get('port', 1.0))
+            if now >= state.next_meter and self.meters.get(dpid):
+                if not self._poll(dp, state, 'meter', now):
+                    self._back_off(state, 'meter')
+                state.next_meter = self._next_poll(now, self.poll_interval * state.backoff.get('meter', 1.0))
+            if now >= state.next_flow:
+                if not self._poll(dp, state, 'flow', now):
+                    self._back_off(state, 'flow')
+                state.next_flow = self._next_poll(now, self.flow_stats_interval * state.backoff.get('flow', 1.0))
+            if now >= state.next_fast:
+                # Hot ports have their own requests, in-flight slots and backoff,
+                # which slows down once per round however many ports were skipped
+                sent = [self._poll(dp, state, ('hot', port_no), now) for port_no in self._hot_ports(dpid)]
+                if not all(sent):
+                    self._back_off(state, 'hot')
+                state.next_fast = now + self.fast_poll_interval * state.backoff.get('hot', 1.0)
+
+        for dpid, (xid, sent) in list(self.flow_syncs.items()):
+            if now - sent > self.poll_timeout:
+                # No listing: send the saved state as it is
+                del self.flow_syncs[dpid]
+                self.logger.warning('Switch %s did not list its flows, reinstalling everything', dpid)
+                self._reinstall_state(self.datapaths[dpid], sent)
+
+        self._expire_in_flight(now)
+        for dpid, port_no in self.port_wheel.advance(now):
+            self._port_deadline(dpid, port_no, now)
+
+    def _next_poll(self, now, interval):
+        return now + interval * (1 + random.uniform(-self.poll_jitter, self.poll_jitter))
+
+    def _hot_ports(self, dpid):
+        # Ports whose last rate is within near_threshold_ratio of their threshold
+        table = self.port_tables.get(dpid)
+        if table is None:
+            return []
+        near = np.maximum(table.rx_rate, table.tx_rate) >= table.threshold * self.near_threshold_ratio
+        return table.port_nos[near & table.has_rate].tolist()
+
+    @staticmethod
+    def _poll_kind(key):
+        return key if isinstance(key, str) else key[0]
+
+    def _poll(self, datapath, state, key, now):
+        kind = self._poll_kind(key)
+        if key in state.keys:
+            # The previous request has not been answered yet: skip this round
+            self.stats_poll_skipped_counter.labels(kind=kind).inc()
+            return False
+
+        self.logger.debug('send %s stats request: %016x', kind, datapath.id)
         ofproto = datapath.ofproto
         parser = datapath.ofproto_parser
-
-        req = parser.OFPFlowStatsRequest(datapath)
+        if key == 'flow':
+            req = parser.OFPFlowStatsRequest(datapath)
+        elif key == 'port':
+            req = parser.OFPPortStatsRequest(datapath, 0, ofproto.OFPP_ANY)
+        elif key == 'meter':
+            req = parser.OFPMeterStatsRequest(datapath, 0, ofproto.OFPM_ALL)
+        else:
+            req = parser.OFPPortStatsRequest(datapath, 0, key[1])
+        datapath.set_xid(req)
+        state.pending[req.xid] = (key, now)
+        state.keys[key] = req.xid
         datapath.send_msg(req)
+        return True
+
+    def _back_off(self, state, kind):
+        # Slow a kind of poll down rather than piling up requests on a slow switch
+        state.backoff[kind] = min(state.backoff.get(kind, 1.0) * 2, self.poll_max_backoff)
+
+    def _expire_polls(self, state, now):
+        for xid, (key, sent) in list(state.pending.items()):
+            if now - sent > self.poll_timeout:
+                del state.pending[xid]
+                del state.keys[key]
+                self.stats_poll_timeout_counter.labels(kind=self._poll_kind(key)).inc()
+
+    def _complete_poll(self, msg):
+        # Called for every stats reply; only the final part of a multipart reply
+        # completes the request. Returns the time the request was sent then.
+        if msg.flags & msg.datapath.ofproto.OFPMPF_REPLY_MORE:
+            return None
+        state = self.poll_state.get(msg.datapath.id)
+        if state is None:
+            return None
+        entry = state.pending.pop(msg.xid, None)
+        if entry is None:
+            return None
+        key, sent = entry
+        del state.keys[key]
+        kind = self._poll_kind(key)
+        self.stats_poll_rtt_histogram.labels(kind=kind).observe(time.time() - sent)
+        # Each timely reply halves the multiplier, so a switch that answers just
+        # under poll_timeout settles at a longer interval instead of swinging
+        backoff = state.backoff.get(kind)
+        if backoff is not None:
+            if backoff <= 2:
+                del state.backoff[kind]
+            else:
+                state.backoff[kind] = backoff / 2
+        return sent
 
-        req = parser.OFPPortStatsRequest(datapath, 0, ofproto.OFPP_ANY)
-        datapath.send_msg(req)
+    @set_ev_cls(ofp_event.EventOFPFlowStatsReply, [CONFIG_DISPATCHER, MAIN_DISPATCHER])
+    def _flow_stats_reply_handler(self, ev):
+        sent = self._complete_poll(ev.msg)
+        msg = ev.msg
+        datapath = msg.datapath
+        dpid = datapath.id
+        now = time.time()
+        last = not msg.flags & datapath.ofproto.OFPMPF_REPLY_MORE
+
+        table = self.shadow_flows.get(dpid)
+        if table is not None:
+            table.collect(msg.xid, msg.body)
+        sync = self.flow_syncs.get(dpid)
+        if sync is not None and sync[0] == msg.xid:
+            # The listing requested at connect: not a traffic sample
+            if last:
+                del self.flow_syncs[dpid]
+                table.reconcile(msg.xid, sync[1])
+                self._reinstall_state(datapath, sync[1])
+            return
+        if last and table is not None:
+            if sent is None or dpid not in self.datapaths:
+                table.pending.pop(msg.xid, None)
+            else:
+                self._repair_flows(datapath, table, table.reconcile(msg.xid, sent))
+
+        elapsed = now - self.heavy_hitter_decay_time
+        if elapsed >= 1:
+            self.heavy_hitters.decay(0.5 ** (elapsed / self.heavy_hitter_half_life))
+            self.heavy_hitter_decay_time = now
+
+        # The first reply after a (re)connect or restart only records where the
+        # counters stand: their lifetime totals are not traffic of this interval
+        previous = self.flow_byte_counts.get(dpid)
+        current = self.flow_byte_pending.setdefault(dpid, {})
+        for stat in msg.body:
+            if stat.cookie != LEARNED_FLOW_COOKIE:
+                continue  # Restored flows have no source to score; security rules carry no traffic
+            match = stat.match
+            key = (match.get('in_port'), match.get('eth_src'), match.get('eth_dst'))
+            current[key] = stat.byte_count
+            if previous is None:
+                continue
+            # A new or reinstalled flow counts all of its bytes
+            delta = stat.byte_count - previous.get(key, 0)
+            if delta < 0:
+                delta = stat.byte_count
+            if delta:
+                self.heavy_hitters.add((dpid, key[0], key[1]), delta)
+
+        if not msg.flags & msg.datapath.ofproto.OFPMPF_REPLY_MORE:
+            # Flows missing from the full reply are gone from the switch
+            self.flow_byte_counts[dpid] = self.flow_byte_pending.pop(dpid)
+
+    def _repair_flows(self, datapath, table, lost):
+        # Send the permanent flows a switch lost again, once
+        if not lost:
+            return
+        self.logger.warning('Switch %s lost %d flows, sending them again', datapath.id, len(lost))
+        self.flow_drift_counter.inc(len(lost))
+        parser = datapath.ofproto_parser
+        for key, entry in lost:
+            self._send_flow_mod(datapath, parser.OFPFlowMod(
+                datapath=datapath, table_id=key[0], priority=key[1], match=parser.OFPMatch(**dict(key[2])),
+                instructions=entry.instructions, cookie=entry.cookie, flags=entry.flags,
+                idle_timeout=entry.idle_timeout, hard_timeout=entry.hard_timeout))
+            table.entries[key].repaired = True
+
+    @set_ev_cls(ofp_event.EventOFPFlowRemoved, MAIN_DISPATCHER)
+    def _flow_removed_handler(self, ev):
+        msg = ev.msg
+        table = self.shadow_flows.get(msg.datapath.id)
+        # Deletes sent from here already updated the table (and may have been followed by a new ADD)
+        if table is not None and msg.reason != msg.datapath.ofproto.OFPRR_DELETE:
+            table.removed(ShadowFlowTable.key(msg), msg.cookie)
+
+    def top_talkers(self, n=10):
+        # Current heavy hitters merged by source MAC, highest estimated rate first.
+        # A steady rate r converges to a score of r * half_life / ln 2.
+        scale = math.log(2) / self.heavy_hitter_half_life
+        talkers = {}
+        if n <= 0:
+            return []
+        for (dpid, in_port, mac), count, error in self.heavy_hitters.top(len(self.heavy_hitters)):
+            if mac in talkers:
+                continue  # The same source seen further from its ingress switch
+            talkers[mac] = {'mac': mac, 'ip': self.inventory.ip_of(mac), 'dpid': dpid, 'port': in_port,
+                            'rate': count * scale, 'error': error * scale}
+            if len(talkers) == n:
+                break
+        return list(talkers.values())
+
+    def _block_top_talker(self, dpid, port_no):
+        # Block the heaviest known source entering through (dpid, port_no);
+        # returns False when there is none to block
+        for talker in self.top_talkers(self.heavy_hitters.capacity):
+            if talker['dpid'] != dpid or talker['port'] != port_no:
+                continue
+            ip = talker['ip']
+            if ip is None or self.blocked_trie.covering(parse_block_entry(ip)):
+                continue
+            self.logger.warning('Blocking top talker %s (%s) on port %s of switch %s',
+                                ip, talker['mac'], port_no, dpid)
+            self.block_ips([ip])
+            return True
+        return False
 
     @set_ev_cls(ofp_event.EventOFPPortStatsReply, MAIN_DISPATCHER)
     def _port_stats_reply_handler(self, ev):
+        start = time.perf_counter()
+        try:
+            self._handle_port_stats(ev)
+        finally:
+            self.port_stats_latency_histogram.observe(time.perf_counter() - start)
+
+    def _handle_port_stats(self, ev):
+        self._complete_poll(ev.msg)
+
         # Extract the body of the message containing port statistics
         body = ev.msg.body
         
         # Get the datapath ID from the event message
         dpid = ev.msg.datapath.id
         
-        # Initialize dictionaries to store port statistics, throughput, and history if not already initialized
-        self.port_stats.setdefault(dpid, {})
-        self.port_throughput.setdefault(dpid, {})
-        self.throughput_history.setdefault(dpid, {})
+        table = self.port_tables.get(dpid)
+        if table is None:
+            table = self.port_tables[dpid] = PortStatsTable()
         
         # Get the current timestamp for calculating throughput intervals
         timestamp = time.time()
 
-        # Iterate through each port's statistics in the message body
-        for stat in body:
-            # Extract port number, received bytes, and transmitted bytes from the statistics
-            port_no = stat.port_no
-            rx_bytes = stat.rx_bytes
-            tx_bytes = stat.tx_bytes
-
-            # If port statistics for this datapath and port number are not yet recorded, initialize them
-            if port_no not in self.port_stats[dpid]:
-                self.port_stats[dpid][port_no] = {'rx_bytes': rx_bytes, 'tx_bytes': tx_bytes, 'timestamp': timestamp}
-                continue
-
-            # Calculate the time interval since the last recorded statistics
-            prev_stats = self.port_stats[dpid][port_no]
-            interval = timestamp - prev_stats['timestamp']
-
-            # Calculate throughput rates in bytes per second for both receive and transmit directions
-            rx_throughput = (rx_bytes - prev_stats['rx_bytes']) / interval
-            tx_throughput = (tx_bytes - prev_stats['tx_bytes']) / interval
+        # Pull the counters of the whole reply into arrays and compute all rates at once
+        count = len(body)
+        port_nos = tuple(stat.port_no for stat in body)
+        rx_bytes = np.fromiter((stat.rx_bytes for stat in body), dtype=np.float64, count=count)
+        tx_bytes = np.fromiter((stat.tx_bytes for stat in body), dtype=np.float64, count=count)
 
-            # Record the calculated throughput rates in the throughput dictionary
-            self.port_throughput[dpid][port_no] = {'rx_throughput': rx_throughput, 'tx_throughput': tx_throughput}
+        rows = table.rows(port_nos, lambda port_no: self._port_threshold(dpid, port_no))
+        valid = table.update(rows, rx_bytes, tx_bytes, timestamp, self.ewma_alpha)
+        rows = rows[valid]
+        self._record_history(dpid, table, rows, timestamp)
 
-            self.port_rx_throughput_gauge.labels(dpid=str(dpid), port=str(port_no)).set(rx_throughput)
-            # Update the port statistics with the current values and timestamp
-            self.port_stats[dpid][port_no] = {'rx_bytes': rx_bytes, 'tx_bytes': tx_bytes, 'timestamp': timestamp}
-
-            # Check if the current throughput exceeds the dynamic threshold and take appropriate actions
-            self.check_port_threshold(dpid, port_no, rx_throughput, tx_throughput, timestamp)
+        if self.threshold_on_ewma:
+            rx_throughput = table.rx_ewma[rows]
+            tx_throughput = table.tx_ewma[rows]
+        else:
+            rx_throughput = table.rx_rate[rows]
+            tx_throughput = table.tx_rate[rows]
+        threshold = table.threshold[rows]
+        above = (rx_throughput > threshold) | (tx_throughput > threshold)
+
+        children = self._port_metrics(dpid, table)
+        for row, rx_rate, tx_rate in zip(rows.tolist(), table.rx_rate[rows].tolist(), table.tx_rate[rows].tolist()):
+            rx_child, tx_child = children[row]
+            rx_child.set(rx_rate)
+            tx_child.set(tx_rate)
+
+        # Only ports that are above threshold or already have block/unblock state
+        # need the per-port decision logic; in meter mode the switch polices them
+        if self.enforcement_mode == 'meter':
+            above[:] = False
+        tracked = self._tracked_ports(dpid)
+        if tracked:
+            above |= np.isin(table.port_nos[rows], tracked)
+        for i in np.flatnonzero(above):
+            self.check_port_threshold(dpid, int(table.port_nos[rows[i]]),
+                                      float(rx_throughput[i]), float(tx_throughput[i]),
+                                      timestamp, float(threshold[i]))
 
         # Log port statistics every 10 seconds
         if timestamp - self.last_log_time >= 10:
-            for dpid in self.port_throughput:
-                for port_no in self.port_throughput[dpid]:
-                    rx_throughput = self.port_throughput[dpid][port_no]['rx_throughput']
-                    tx_throughput = self.port_throughput[dpid][port_no]['tx_throughput']
-                    dynamic_threshold = self.link_bandwidth.get(str(dpid), {}).get(str(port_no), self.initial_threshold)
+            for log_dpid, log_table in self.port_tables.items():
+                for row in np.flatnonzero(log_table.has_rate):
                     self.logger.info('Port %s on switch %s - RX: %s bytes/s, TX: %s bytes/s, Threshold: %s bytes/s',
-                                    port_no, dpid, rx_throughput, tx_throughput, dynamic_threshold)
+                                     log_table.port_nos[row], log_dpid, log_table.rx_rate[row],
+                                     log_table.tx_rate[row], log_table.threshold[row])
             self.last_log_time = timestamp
 
-
-    def check_port_threshold(self, dpid, port_no, rx_throughput, tx_throughput, timestamp):
-        # Calculate the dynamic threshold based on configured link bandwidth or use default
-        dynamic_threshold = self.link_bandwidth.get(str(dpid), {}).get(str(port_no), self.initial_threshold)
-        
-        # Check if current throughput exceeds the dynamic threshold
-        if (rx_throughput > dynamic_threshold or tx_throughput > dynamic_threshold):
-            # If port is not already marked as above threshold, record the time
-            if (dpid, port_no) not in self.above_threshold_time:
-                self.above_threshold_time[(dpid, port_no)] = timestamp
-            # If the port has been above threshold for longer than block window, block it
-            elif timestamp - self.above_threshold_time[(dpid, port_no)] > self.block_window:
-                # If port is not already blocked, log a warning and block the port
-                print(f"Real-time throughput on port {port_no} of switch {dpid}: RX={rx_throughput}, TX={tx_throughput}, Threshold={dynamic_threshold}")
-                if (dpid, port_no) not in self.blocked_ports:
-                    self.logger.warning('Threshold exceeded on port %s of switch %s', port_no, dpid)
-                    self._block_port(dpid, port_no)
-                    self.blocked_ports[(dpid, port_no)] = timestamp  # Record the time when the port was blocked
-                    self.below_threshold_time[(dpid, port_no)] = None  # Reset the below threshold timer
+    def _record_history(self, dpid, table, rows, now):
+        rings = self.throughput_history.get(dpid)
+        if rings is None:
+            rings = self.throughput_history[dpid] = [ThroughputRing(resolution, slots)
+                                                     for resolution, slots in self.history_levels]
+        rx_rate = table.rx_rate[rows]
+        tx_rate = table.tx_rate[rows]
+        for ring in rings:
+            ring.grow(len(table.port_nos))
+            ring.add(rows, rx_rate, tx_rate, now)
+
+    def throughput_window(self, start, end, resolution=None, dpid=None, port_no=None):
+        # Rates of every port (or one switch / port) from start to end at the
+        # finest level that still holds `start`, or at `resolution` when given.
+        # Returns None for a resolution that is not one of history_levels.
+        resolutions = [level[0] for level in self.history_levels]
+        if resolution is None:
+            now = time.time()
+            for resolution, slots in self.history_levels:
+                if now - start <= resolution * slots:
+                    break
+        elif resolution not in resolutions:
+            return None
+        level = resolutions.index(resolution)
+        # Bucket numbers of the window, clipped to one lap of the ring
+        last = int(end // resolution)
+        first = max(int(start // resolution), last - self.history_levels[level][1] + 1)
+
+        switches = {}
+        for history_dpid, rings in self.throughput_history.items():
+            if dpid is not None and history_dpid != dpid:
+                continue
+            table = self.port_tables[history_dpid]
+            ports = {}
+            for history_port, row in table.index.items():
+                if port_no is not None and history_port != port_no:
+                    continue
+                rx, tx = rings[level].window(row, first, last)
+                ports[str(history_port)] = {'rx': [None if math.isnan(v) else v for v in rx.tolist()],
+                                            'tx': [None if math.isnan(v) else v for v in tx.tolist()]}
+            switches[str(history_dpid)] = ports
+        return {'resolution': resolution, 'start': first * resolution, 'switches': switches}
+
+    def _port_metrics(self, dpid, table):
+        # Gauge children indexed like the rows of `table`
+        children = self.port_metric_children.setdefault(dpid, [])
+        for port_no in table.port_nos[len(children):].tolist():
+            children.append((self.port_rx_throughput_gauge.labels(dpid=str(dpid), port=str(port_no)),
+                             self.port_tx_throughput_gauge.labels(dpid=str(dpid), port=str(port_no))))
+        return children
+
+    def _port_threshold(self, dpid, port_no):
+        return self.threshold_policy.threshold(dpid, port_no)
+
+    def _port_meter(self, dpid, port_no):
+        # Meter id for flows entering through (dpid, port_no), None when unmetered
+        if port_no in self.meters.get(dpid, ()):
+            return port_no
+        return None
+
+    def _install_meters(self, datapath):
+        # Replace whatever meters the switch has with one per physical port
+        ofproto = datapath.ofproto
+        parser = datapath.ofproto_parser
+        datapath.send_msg(parser.OFPMeterMod(datapath, ofproto.OFPMC_DELETE, meter_id=ofproto.OFPM_ALL))
+        self._shadow_table(datapath.id).drop_metered()
+        self.meters[datapath.id] = {}
+        for port_no in sorted(datapath.ports):
+            if port_no <= ofproto.OFPM_MAX:  # the meter id is the port number
+                self._add_meter(datapath, port_no)
+
+    def _meter_rate(self, dpid, port_no):
+        # Threshold is in bytes/s, meter rates in kbit/s
+        return max(1, int(self._port_threshold(dpid, port_no) * 8 / 1000))
+
+    def _add_meter(self, datapath, port_no, command=None):
+        ofproto = datapath.ofproto
+        parser = datapath.ofproto_parser
+        rate = self._meter_rate(datapath.id, port_no)
+        bands = [parser.OFPMeterBandDrop(rate=rate, burst_size=max(1, int(rate * self.meter_burst)))]
+        datapath.send_msg(parser.OFPMeterMod(datapath, ofproto.OFPMC_ADD if command is None else command,
+                                             ofproto.OFPMF_KBPS | ofproto.OFPMF_BURST | ofproto.OFPMF_STATS,
+                                             port_no, bands))
+        self.meters[datapath.id][port_no] = rate
+
+    @set_ev_cls(ofp_event.EventOFPMeterStatsReply, MAIN_DISPATCHER)
+    def _meter_stats_reply_handler(self, ev):
+        self._complete_poll(ev.msg)
+        dpid = ev.msg.datapath.id
+        meters = self.meters.get(dpid, ())
+        for stat in ev.msg.body:
+            if stat.meter_id not in meters:
+                continue
+            children = self.meter_metric_children.get((dpid, stat.meter_id))
+            if children is None:
+                labels = {'dpid': str(dpid), 'port': str(stat.meter_id)}
+                children = self.meter_metric_children[(dpid, stat.meter_id)] = (
+                    self.meter_in_bytes_gauge.labels(**labels), self.meter_dropped_bytes_gauge.labels(**labels))
+            children[0].set(stat.byte_in_count)
+            children[1].set(sum(band.byte_band_count for band in stat.band_stats))
+
+    def _tracked_ports(self, dpid):
+        # Ports of `dpid` with threshold state
+        return list(self.port_states.get(dpid, ()))
+
+    def check_port_threshold(self, dpid, port_no, rx_throughput, tx_throughput, timestamp,
+                             dynamic_threshold=None):
+        # Feed one stats sample into the port's state machine. Only the moves a
+        # sample causes happen here; block_window, unlock_timeout and
+        # reblock_window expire in _port_deadline.
+        if dynamic_threshold is None:
+            dynamic_threshold = self._port_threshold(dpid, port_no)
+        rate = max(rx_throughput, tx_throughput)
+        entry = self.port_states.get(dpid, {}).get(port_no)
+        state = entry.state if entry is not None else PORT_NORMAL
+
+        if rate > dynamic_threshold:
+            if state == PORT_NORMAL:
+                entry = self._port_transition(dpid, port_no, PORT_ABOVE, timestamp)
+            elif state == PORT_BLOCKED:
+                # Still over: push the unblock deadline out, so it only fires by
+                # itself when the switch stops reporting
+                self.port_wheel.schedule((dpid, port_no), timestamp + self.unlock_timeout)
+            elif state == PORT_UNBLOCKING:
+                self._port_transition(dpid, port_no, PORT_BLOCKED, timestamp)
+            elif state == PORT_RECENT:
+                self.logger.warning('Threshold exceeded again on port %s of switch %s within %s second of unblock',
+                                    port_no, dpid, self.reblock_window)
+                self._auto_block(dpid, port_no, timestamp)
+            entry.rate = rate
+            entry.threshold = dynamic_threshold
+        elif state == PORT_ABOVE:
+            self._port_transition(dpid, port_no, PORT_NORMAL, timestamp)
+        elif state == PORT_BLOCKED:
+            self._port_transition(dpid, port_no, PORT_UNBLOCKING, timestamp)
+
+    def _port_deadline(self, dpid, port_no, now):
+        entry = self.port_states.get(dpid, {}).get(port_no)
+        if entry is None:
+            return
+        if entry.state == PORT_ABOVE:
+            if dpid in self.datapaths:
+                self.logger.warning('Threshold exceeded on port %s of switch %s for %s seconds: %.0f bytes/s, '
+                                    'threshold %.0f bytes/s', port_no, dpid, self.block_window,
+                                    entry.rate, entry.threshold)
+                self._auto_block(dpid, port_no, now)
+            else:
+                self._port_transition(dpid, port_no, PORT_NORMAL, now)  # switch gone
+        elif entry.state in (PORT_BLOCKED, PORT_UNBLOCKING):
+            # _port_unblocked moves the port on to PORT_RECENT
+            self._unblock_port(dpid, port_no)
+            if entry.state in (PORT_BLOCKED, PORT_UNBLOCKING):
+                self._port_transition(dpid, port_no, PORT_NORMAL, now)  # unblocked elsewhere or already gone
+        elif entry.state == PORT_RECENT:
+            self._port_transition(dpid, port_no, PORT_NORMAL, now)
+
+    def _auto_block(self, dpid, port_no, now):
+        if self.source_mitigation and self._block_top_talker(dpid, port_no):
+            # Start a fresh window to see whether blocking the source was enough
+            self._port_transition(dpid, port_no, PORT_ABOVE, now)
+            return
+        self._block_port(dpid, port_no)
+        self._port_transition(dpid, port_no, PORT_BLOCKED, now)
+
+    def _port_transition(self, dpid, port_no, state, now):
+        # Move a port to `state` and schedule that state's deadline; returns the PortState
+        ports = self.port_states.setdefault(dpid, {})
+        entry = ports.get(port_no)
+        old = entry.state if entry is not None else PORT_NORMAL
+        if state == PORT_NORMAL:
+            ports.pop(port_no, None)
+            if not ports:
+                del self.port_states[dpid]
+            self.port_wheel.cancel((dpid, port_no))
         else:
-            # If port was marked as above threshold, remove the record
-            if (dpid, port_no) in self.above_threshold_time:
-                del self.above_threshold_time[(dpid, port_no)]
-            # If port is currently blocked, track the time it remains below threshold
-            if (dpid, port_no) in self.blocked_ports:
-                if self.below_threshold_time.get((dpid, port_no)) is None:
-                    self.below_threshold_time[(dpid, port_no)] = timestamp
-                # If the port has been below threshold long enough, unblock it
-                elif timestamp - self.below_threshold_time[(dpid, port_no)] > self.unlock_timeout:
-                    del self.blocked_ports[(dpid, port_no)]
-                    del self.below_threshold_time[(dpid, port_no)]
-                    self._unblock_port(dpid, port_no)
-
-            # Check if the port was recently unblocked and exceeds threshold again within 1 second
-            if (dpid, port_no) in self.last_unblock_time and self.last_unblock_time[(dpid, port_no)] is not None:
-                if timestamp - self.last_unblock_time[(dpid, port_no)] <= 1 and (rx_throughput > dynamic_threshold or tx_throughput > dynamic_threshold):
-                    self.logger.warning('Threshold exceeded again on port %s of switch %s within 1 second of unblock', port_no, dpid)
-                    self._block_port(dpid, port_no)
-                    self.blocked_ports[(dpid, port_no)] = timestamp  # Record the time when the port was blocked
-
-                    
+            if entry is None:
+                entry = ports[port_no] = PortState(state, now)
+            entry.state = state
+            entry.since = now
+            timeout = self.block_window if state == PORT_ABOVE else \
+                self.reblock_window if state == PORT_RECENT else self.unlock_timeout
+            self.port_wheel.schedule((dpid, port_no), now + timeout)
+            self.port_state_children[state].inc()
+        if old != PORT_NORMAL:
+            self.port_state_children[old].dec()
+
+        child = self.port_transition_children.get((old, state))
+        if child is None:
+            child = self.port_transition_children[(old, state)] = \
+                self.port_transition_counter.labels(from_state=old, to_state=state)
+        child.inc()
+        return entry
+
     def _block_port(self, dpid, port_no):
         datapath = self.datapaths.get(dpid)
         if datapath is None:
+            if self._shard_route_ports([(dpid, port_no)], True)[1]:
+                return
             self.logger.error('Datapath %s not found', dpid)
             return
         
-        ofproto = datapath.ofproto
+        self._send_flow_mod(datapath, self._block_port_mod(datapath, port_no))
+        self._port_blocked(dpid, port_no)
+
+    def _block_port_mod(self, datapath, port_no):
         parser = datapath.ofproto_parser
         
         match = parser.OFPMatch(
@@ -357,17 +2901,32 @@ class SimpleSwitch13(app_manager.RyuApp):
             ip_proto=1        # ICMP
         )      
         actions = []  # Drop all packets
-        self.add_flow(datapath, self.security_priority, match, actions)
-        
+        return self._add_flow_mod(datapath, self.security_priority, match, actions)
+
+    def _port_blocked(self, dpid, port_no):
         self.logger.info('\n---\n---\nBlocking port %s on switch %s\n---\n---\n', port_no, dpid)
-        self.last_unblock_time[(dpid, port_no)] = None  # Reset last unblock time
+        self.pending_unblocks.discard((dpid, port_no))
+        self.port_blocks.add((dpid, port_no))
+        self.journal.append('port_block', dpid, port_no)
+        self.snapshot.touch('ports')
 
     def _unblock_port(self, dpid, port_no):
         datapath = self.datapaths.get(dpid)
         if datapath is None:
+            if self._shard_route_ports([(dpid, port_no)], False)[1]:
+                return
+            if (dpid, port_no) in self.port_blocks:
+                # Switch not connected: drop the block now, its rule goes when the switch is back
+                self.pending_unblocks.add((dpid, port_no))
+                self._port_unblocked(dpid, port_no)
+                return
             self.logger.error('Datapath %s not found', dpid)
             return
         
+        self._send_flow_mod(datapath, self._unblock_port_mod(datapath, port_no))
+        self._port_unblocked(dpid, port_no)
+
+    def _unblock_port_mod(self, datapath, port_no):
         ofproto = datapath.ofproto
         parser = datapath.ofproto_parser
         
@@ -376,7 +2935,7 @@ class SimpleSwitch13(app_manager.RyuApp):
                 in_port=port_no,
                 eth_type=0x0800,  
                 ip_proto=1 )
-        mod = parser.OFPFlowMod(
+        return parser.OFPFlowMod(
             datapath=datapath,
             command=ofproto.OFPFC_DELETE_STRICT,  # Use DELETE_STRICT to delete specific flow
             out_port=ofproto.OFPP_ANY,
@@ -384,24 +2943,371 @@ class SimpleSwitch13(app_manager.RyuApp):
             match=match,
             priority=self.security_priority  # Use the same priority as the block rule
         )
-        datapath.send_msg(mod)
-        
+
+    def _port_unblocked(self, dpid, port_no):
         self.logger.info('\n---\n---\nUnblocking port %s on switch %s\n---\n---\n', port_no, dpid)
-        self.last_unblock_time[(dpid, port_no)] = time.time()  # Record the time when the port was unblocked
+        entry = self.port_states.get(dpid, {}).get(port_no)
+        if entry is not None and entry.state in (PORT_BLOCKED, PORT_UNBLOCKING):
+            self._port_transition(dpid, port_no, PORT_RECENT, time.time())
+        self.port_blocks.discard((dpid, port_no))
+        self.journal.append('port_unblock', dpid, port_no)
+        self.snapshot.touch('ports')
 
     def block_ip(self, datapath, ip_addr):
+        self._send_flow_mod(datapath, self._block_ip_mod(datapath, ip_addr))
+
+    def _block_ip_mod(self, datapath, ip_addr):
         parser = datapath.ofproto_parser
-        match = parser.OFPMatch(eth_type=0x0800, ipv4_src=ip_addr)  # Chặn gói tin từ IP nguồn
+        match = parser.OFPMatch(eth_type=0x0800, ipv4_src=self._ipv4_src(ip_addr))  # Chặn gói tin từ IP nguồn
         actions = []  # Không có hành động => Drop
-        self.add_flow(datapath, self.security_priority, match, actions)
+        return self._add_flow_mod(datapath, self.security_priority, match, actions)
     
     def unblock_ip(self, datapath, ip_addr):
+        self._send_flow_mod(datapath, self._unblock_ip_mod(datapath, ip_addr))
+
+    def _unblock_ip_mod(self, datapath, ip_addr):
+        # Strict delete, so removing an aggregate leaves the narrower rules replacing it
         parser = datapath.ofproto_parser
-        match = parser.OFPMatch(eth_type=0x0800, ipv4_src=ip_addr)  # Xóa luật chặn IP nguồn
-        mod = parser.OFPFlowMod(datapath=datapath, command=datapath.ofproto.OFPFC_DELETE,
-                                out_port=datapath.ofproto.OFPP_ANY, out_group=datapath.ofproto.OFPG_ANY,
-                                match=match)
-        datapath.send_msg(mod)
+        match = parser.OFPMatch(eth_type=0x0800, ipv4_src=self._ipv4_src(ip_addr))  # Xóa luật chặn IP nguồn
+        return parser.OFPFlowMod(datapath=datapath, command=datapath.ofproto.OFPFC_DELETE_STRICT,
+                                 out_port=datapath.ofproto.OFPP_ANY, out_group=datapath.ofproto.OFPG_ANY,
+                                 priority=self.security_priority, match=match)
+
+    def _ipv4_src(self, ip_addr):
+        # ipv4_src match value: exact address for a /32, (address, netmask) otherwise.
+        # `ip_addr` is a block list string or one of the block_rules networks.
+        network = ip_addr if isinstance(ip_addr, ipaddress.IPv4Network) else parse_block_entry(ip_addr)
+        if network.prefixlen == 32:
+            return str(network.network_address)
+        return (str(network.network_address), str(network.netmask))
+
+    def block_ips(self, entries):
+        # Add addresses / CIDR prefixes to the block list and install the
+        # resulting drop rules on every switch; returns the FlowBatchResult
+        keys = [block_entry_key(parse_block_entry(entry)) for entry in entries]
+        self._stamp_blocks(keys, True)
+        return self._apply_blocks(keys, [])
+
+    def unblock_ips(self, entries):
+        keys = [block_entry_key(parse_block_entry(entry)) for entry in entries]
+        self._stamp_blocks(keys, False)
+        return self._apply_blocks([], keys)
+
+    def _apply_blocks(self, blocked, unblocked):
+        for key in blocked:
+            self.blocked_ips.add(key)
+            self.blocked_trie.insert(parse_block_entry(key))
+            self.journal.append('block', key)
+        for key in unblocked:
+            self.blocked_ips.discard(key)
+            self.blocked_trie.remove(parse_block_entry(key))
+            self.journal.append('unblock', key)
+        return self._sync_block_rules()
+
+    def _sync_block_rules(self):
+        self.snapshot.touch('blocked_ips')
+
+        # Adjacent and contained prefixes are merged into the fewest CIDR blocks,
+        # and only the difference to what is installed is sent
+        target = set(ipaddress.collapse_addresses(self.blocked_trie.networks()))
+        added = sorted(target - self.block_rules)
+        removed = sorted(self.block_rules - target)
+        self.block_rules = target
+        if not added and not removed:
+            return self.send_flow_batches({})
+        # New rules go in before the ones they replace are deleted, so nothing slips through
+        return self.send_flow_batches(dict(
+            (dpid, [self._block_ip_mod(dp, network) for network in added] +
+                   [self._unblock_ip_mod(dp, network) for network in removed])
+            for dpid, dp in self.datapaths.items()))
+
+    def block_ports(self, ports):
+        # Block a list of (dpid, port_no) pairs, grouped into one batch per switch
+        batches = {}
+        ports, forwarded = self._shard_route_ports(ports, True)
+        for dpid, port_no in ports:
+            datapath = self.datapaths.get(dpid)
+            batches.setdefault(dpid, [])
+            if datapath is not None:
+                batches[dpid].append(self._block_port_mod(datapath, port_no))
+                self._port_blocked(dpid, port_no)
+        return self._shard_forwarded(self.send_flow_batches(batches), forwarded)
+
+    def unblock_ports(self, ports):
+        batches = {}
+        ports, forwarded = self._shard_route_ports(ports, False)
+        for dpid, port_no in ports:
+            datapath = self.datapaths.get(dpid)
+            batches.setdefault(dpid, [])
+            if datapath is not None:
+                batches[dpid].append(self._unblock_port_mod(datapath, port_no))
+                self._port_unblocked(dpid, port_no)
+        return self._shard_forwarded(self.send_flow_batches(batches), forwarded)
+
+    # Sharding ---------------------------------------------------------------
+
+    def _shard_owns(self, dpid):
+        return self.shard_count == 1 or ShardRing.owner(dpid, self.shard_alive) == self.shard_index
+
+    def _send_role(self, datapath, role):
+        # Generation ids only have to grow; wall-clock milliseconds do that across processes
+        parser = datapath.ofproto_parser
+        datapath.send_msg(parser.OFPRoleRequest(datapath, role, int(time.time() * 1000)))
+
+    def _shard_rebalance(self):
+        # Take over or hand back switches after the set of live shards changed
+        for dpid, datapath in list(self.shard_datapaths.items()):
+            owned = dpid in self.datapaths
+            if self._shard_owns(dpid) and not owned:
+                self.logger.info('Shard %d taking over switch %s', self.shard_index, dpid)
+                self._send_role(datapath, datapath.ofproto.OFPCR_ROLE_MASTER)
+                self._adopt_port_blocks(dpid)
+                self._setup_switch(datapath)
+                if self.enforcement_mode == 'meter':
+                    self._install_meters(datapath)
+            elif not self._shard_owns(dpid) and owned:
+                self.logger.info('Shard %d handing switch %s back', self.shard_index, dpid)
+                self._send_role(datapath, datapath.ofproto.OFPCR_ROLE_SLAVE)
+                del self.datapaths[dpid]
+                self._forget_datapath(dpid)
+        self.shard_switches_gauge.set(len(self.datapaths))
+
+    def _adopt_port_blocks(self, dpid):
+        # The previous owner's last published ports view tells which ports it had blocked
+        for views in self.shard_views.values():
+            entry = views.get('ports', {}).get(str(dpid))
+            if entry is not None:
+                for port_no in entry['blocked_ports']:
+                    if (dpid, port_no) not in self.port_blocks:
+                        self.port_blocks.add((dpid, port_no))
+                        self.journal.append('port_block', dpid, port_no)
+
+    def _shard_route_ports(self, ports, block):
+        # Port (un)blocks for switches owned by another shard are forwarded to it;
+        # returns the pairs left for this shard and {shard: forwarded pairs}
+        if self.shard_count == 1:
+            return ports, {}
+        local = []
+        remote = {}
+        for dpid, port_no in ports:
+            if dpid in self.datapaths or dpid not in self.shard_datapaths:
+                local.append((dpid, port_no))
+            else:
+                remote.setdefault(ShardRing.owner(dpid, self.shard_alive), []).append([dpid, port_no])
+        for shard, pairs in remote.items():
+            self._shard_send(shard, {'t': 'ports', 'block': block, 'ports': pairs})
+        return local, remote
+
+    def _shard_forwarded(self, result, forwarded):
+        # Report the forwarded switches in the batch result
+        for shard, pairs in forwarded.items():
+            for dpid, port_no in pairs:
+                entry = result.status.setdefault(dpid, {'status': 'forwarded', 'shard': shard,
+                                                        'flow_mods': 0, 'errors': []})
+                entry['flow_mods'] += 1
+        return result
+
+    def _stamp_blocks(self, keys, blocked):
+        # Stamp local block list changes and send them to the peers
+        if self.shard_count == 1:
+            return
+        stamp = (time.time(), self.shard_index)
+        for key in keys:
+            self.block_stamps[key] = stamp
+        self._shard_broadcast({'t': 'blocks', 'entries': [[key, blocked, stamp[0], stamp[1]] for key in keys]})
+
+    def _merge_blocks(self, entries):
+        # Apply the peers' block list entries that are newer than ours
+        blocked = []
+        unblocked = []
+        for key, is_blocked, t, shard in entries:
+            stamp = (t, shard)
+            if stamp <= self.block_stamps.get(key, (0, -1)):
+                continue
+            self.block_stamps[key] = stamp
+            if is_blocked and key not in self.blocked_ips:
+                blocked.append(key)
+            elif not is_blocked and key in self.blocked_ips:
+                unblocked.append(key)
+        if blocked or unblocked:
+            self._apply_blocks(blocked, unblocked)
+
+    def _block_digest(self):
+        return zlib.crc32('\n'.join(sorted(self.blocked_ips)).encode('ascii'))
+
+    def _shard_view_changed(self, name):
+        if name == 'hosts':
+            self.peer_hosts = None
+        else:
+            self.snapshot.touch(name)
+
+    def _merged_view(self, name):
+        view = self.shared_views[name]()
+        peers = [views[name] for views in self.shard_views.values() if name in views]
+        if not peers:
+            return view
+        if isinstance(view, dict):
+            merged = {}
+            for peer in peers:
+                merged.update(peer)
+            merged.update(view)
+            return merged
+        merged = list(view)
+        for peer in peers:
+            merged.extend(peer)
+        if all(isinstance(item, str) for item in merged):
+            return sorted(set(merged))
+        if all(isinstance(item, dict) and 'mac' in item for item in merged):
+            # A host several shards have seen is listed once: our own entry
+            # first, then the peers' in shard order
+            hosts = OrderedDict()
+            for item in merged:
+                hosts.setdefault(item['mac'], item)
+            return list(hosts.values())
+        return merged
+
+    def _shard_heartbeat_loop(self):
+        beat = 0
+        while True:
+            self._shard_heartbeat_tick(time.time(), beat % self.shard_view_refresh == 0)
+            beat += 1
+            hub.sleep(self.shard_heartbeat)
+
+    def _shard_heartbeat_tick(self, now, refresh):
+        self._shard_broadcast({'t': 'hello', 'blocked': self._block_digest()})
+
+        # Shared views go out when they changed, and in full every few heartbeats
+        # so a peer that lost a datagram catches up
+        for name, builder in self.shared_views.items():
+            body = builder()
+            crc = zlib.crc32(json.dumps(body, sort_keys=True).encode('utf-8'))
+            if refresh or self.shard_sent_views.get(name) != crc:
+                self.shard_sent_views[name] = crc
+                self._shard_broadcast({'t': 'view', 'name': name, 'body': body})
+
+        alive = self.shard_ring.alive(now)
+        if alive != self.shard_alive:
+            self.logger.warning('Live shards changed: %s -> %s', list(self.shard_alive), list(alive))
+            self.shard_alive = alive
+            self._shard_rebalance()
+            for shard in list(self.shard_views):
+                if shard not in alive:
+                    del self.shard_views[shard]
+                    for name in self.shared_views:
+                        self._shard_view_changed(name)
+        self.shard_peers_gauge.set(len(alive) - 1)
+        self.shard_switches_gauge.set(len(self.datapaths))
+
+        for key, stamp in list(self.block_stamps.items()):
+            if key not in self.blocked_ips and now - stamp[0] > self.shard_tombstone_ttl:
+                del self.block_stamps[key]
+        for key, (received, parts) in list(self.shard_fragments.items()):
+            if now - received > self.shard_dead_after:
+                del self.shard_fragments[key]
+
+    def _shard_broadcast(self, msg):
+        for shard in range(self.shard_count):
+            if shard != self.shard_index:
+                self._shard_send(shard, msg)
+
+    def _shard_send(self, shard, msg):
+        # One JSON datagram, or fragments of at most shard_fragment_size bytes
+        msg['shard'] = self.shard_index
+        data = json.dumps(msg)
+        address = ('127.0.0.1', self.shard_base_port + shard)
+        if len(data) <= self.shard_fragment_size:
+            datagrams = [data]
+        else:
+            self.shard_message_id += 1
+            size = self.shard_fragment_size
+            pieces = [data[i:i + size] for i in range(0, len(data), size)]
+            datagrams = [json.dumps({'t': 'fragment', 'shard': self.shard_index, 'id': self.shard_message_id,
+                                     'part': part, 'parts': len(pieces), 'data': piece})
+                         for part, piece in enumerate(pieces)]
+        try:
+            for datagram in datagrams:
+                self.shard_socket.sendto(self._shard_sign(datagram.encode('utf-8')), address)
+                if len(datagrams) > 1:
+                    hub.sleep(0)  # let the receiver drain between fragments
+        except OSError as e:
+            self.logger.debug('Shard %d unreachable: %s', shard, e)
+
+    def _shard_sign(self, payload):
+        if not self.shard_secret:
+            return payload
+        return hmac.new(self.shard_secret, payload, hashlib.sha256).digest() + payload
+
+    def _shard_verify(self, data, address):
+        # Payload of a datagram from a peer shard, or None. Peers send from the
+        # port they listen on, so anything else on this host is turned away.
+        shard = address[1] - self.shard_base_port
+        if address[0] != '127.0.0.1' or not 0 <= shard < self.shard_count or shard == self.shard_index:
+            self.shard_rejected_counter.labels(reason='sender').inc()
+            return None
+        if not self.shard_secret:
+            return data
+        tag, payload = data[:32], data[32:]
+        if not hmac.compare_digest(tag, hmac.new(self.shard_secret, payload, hashlib.sha256).digest()):
+            self.shard_rejected_counter.labels(reason='signature').inc()
+            return None
+        return payload
+
+    def _shard_receive(self):
+        while True:
+            try:
+                data, address = self.shard_socket.recvfrom(65535)
+                payload = self._shard_verify(data, address)
+                if payload is None:
+                    continue
+                msg = json.loads(payload.decode('utf-8'))
+                if msg['shard'] != address[1] - self.shard_base_port:
+                    self.shard_rejected_counter.labels(reason='sender').inc()
+                    continue
+                self._shard_message(msg, time.time())
+            except Exception as e:
+                self.logger.error('Bad shard message: %s', e)
+
+    def _shard_message(self, msg, now):
+        shard = msg['shard']
+        self.shard_ring.heard(shard, now)
+        kind = msg['t']
+        if kind == 'fragment':
+            key = (shard, msg['id'])
+            entry = self.shard_fragments.setdefault(key, [now, {}])
+            entry[1][msg['part']] = msg['data']
+            if len(entry[1]) == msg['parts']:
+                del self.shard_fragments[key]
+                self._shard_message(json.loads(''.join(entry[1][part] for part in range(msg['parts']))), now)
+        elif kind == 'hello':
+            if msg['blocked'] != self._block_digest():
+                # Block lists differ: send ours with stamps, the newer side of each entry wins on both ends
+                # Entries restored from disk carry no stamp yet and lose to any real change
+                entries = [[key, key in self.blocked_ips] + list(self.block_stamps.get(key, (0, self.shard_index)))
+                           for key in set(self.blocked_ips).union(self.block_stamps)]
+                self._shard_send(shard, {'t': 'blocks', 'entries': entries})
+        elif kind == 'blocks':
+            self._merge_blocks(msg['entries'])
+        elif kind == 'view':
+            self.shard_views.setdefault(shard, {})[msg['name']] = msg['body']
+            self._shard_view_changed(msg['name'])
+        elif kind == 'flood':
+            self._flood_data(bytes.fromhex(msg['data']))
+        elif kind == 'ports':
+            # Only ports of switches owned here, so a disagreement on ownership cannot bounce them around
+            pairs = [(dpid, port_no) for dpid, port_no in msg['ports'] if dpid in self.datapaths]
+            if msg['block']:
+                self.block_ports(pairs)
+            else:
+                self.unblock_ports(pairs)
+        elif kind == 'thresholds':
+            self.set_thresholds(msg['entries'], forward=False)
+
+
+if TOPOLOGY_ENABLED:
+    from ryu.topology import event as topo_event
+    set_ev_cls(topo_event.EventLinkAdd)(SimpleSwitch13._link_add_handler)
+    set_ev_cls(topo_event.EventLinkDelete)(SimpleSwitch13._link_delete_handler)
+
 
 class SimpleSwitchController(ControllerBase):
     def __init__(self, req, link, data, **config):
@@ -410,13 +3316,71 @@ class SimpleSwitchController(ControllerBase):
 
     @route('connected_ips', url_connected_ips, methods=['GET'])
     def list_connected_ips(self, req, **kwargs):
-        body = json.dumps(list(self.simple_switch_app.hosts))
+        return self._snapshot_response(req, 'connected_ips')
+
+    @route('hosts', url_hosts, methods=['GET'])
+    def list_hosts(self, req, **kwargs):
+        # ?offset=&limit= (at most 1000) and optional dpid, port (with dpid) and
+        # subnet filters; hosts are ordered by IP
+        try:
+            offset = int(req.GET.get('offset', 0))
+            limit = int(req.GET.get('limit', 100))
+            dpid = int(req.GET['dpid']) if 'dpid' in req.GET else None
+            port_no = int(req.GET['port']) if 'port' in req.GET else None
+            network = ipaddress.IPv4Network(req.GET['subnet'], strict=False) if 'subnet' in req.GET else None
+        except ValueError:
+            return Response(status=400, body="Invalid query.")
+        if offset < 0 or not 0 < limit <= 1000 or (port_no is not None and dpid is None):
+            return Response(status=400, body="Invalid query.")
+        body = json.dumps(self.simple_switch_app.host_page(offset, limit, dpid, port_no, network))
         return Response(content_type='application/json; charset=utf-8', body=body)
 
+    @route('host_to_switch', url_host_to_switch, methods=['GET'])
+    def list_host_to_switch(self, req, **kwargs):
+        return self._snapshot_response(req, 'host_to_switch')
+
     @route('blocked_ips', url_blocked_ips, methods=['GET'])
     def list_blocked_ips(self, req, **kwargs):
-        body = json.dumps(list(self.simple_switch_app.blocked_ips))
-        return Response(content_type='application/json; charset=utf-8', body=body)
+        return self._snapshot_response(req, 'blocked_ips')
+
+    def _snapshot_response(self, req, name):
+        # Served from the cached snapshot; clients revalidate with If-None-Match
+        version, body = self.simple_switch_app.snapshot.get(name)
+        etag = '{}-{}'.format(name, version)
+        if etag in req.if_none_match:
+            response = Response(status=304)
+        else:
+            response = Response(content_type='application/json; charset=utf-8', body=body)
+        response.etag = etag
+        response.cache_control = 'no-cache'
+        return response
+
+    @route('events', url_events, methods=['GET'])
+    def stream_events(self, req, **kwargs):
+        # Server-Sent Events: one 'event: <section>' message with the section's
+        # JSON each time it changes. Resumes after Last-Event-ID when given.
+        snapshot = self.simple_switch_app.snapshot
+        try:
+            since = int(req.headers.get('Last-Event-ID', req.GET.get('since', -1)))
+        except ValueError:
+            since = -1
+        response = Response(content_type='text/event-stream', charset=None,
+                            app_iter=self._event_stream(snapshot, since))
+        response.cache_control = 'no-cache'
+        return response
+
+    def _event_stream(self, snapshot, since):
+        keepalive = self.simple_switch_app.event_keepalive
+        while True:
+            names = snapshot.changes(since)
+            if not names:
+                if not snapshot.wait(since, keepalive):
+                    yield b': keepalive\n\n'
+                continue
+            since = snapshot.version
+            for name in names:
+                version, body = snapshot.get(name)
+                yield b'id: %d\nevent: %s\ndata: %s\n\n' % (since, name.encode('ascii'), body)
 
     @route('block_ip', url_block_ip, methods=['POST'])
     def block_ip(self, req, **kwargs):
@@ -425,12 +3389,19 @@ class SimpleSwitchController(ControllerBase):
             ip = new_data.get('ip')
             if not ip:
                 return Response(status=400, body="Missing IP address.")
-            if ip in self.simple_switch_app.blocked_ips:
-                return Response(status=400, body="IP already blocked.")
-            self.simple_switch_app.blocked_ips.add(ip)
-            for dp in self.simple_switch_app.datapaths.values():
-                self.simple_switch_app.block_ip(dp, ip)
-            return Response(status=200, body="Blocked IP: {}".format(ip))
+            try:
+                network = parse_block_entry(ip)
+            except ValueError as e:
+                return Response(status=400, body="Invalid IP address or prefix: {}".format(e))
+            covering = self.simple_switch_app.blocked_trie.covering(network)
+            if covering:
+                return Response(status=400, body="IP already blocked by {}.".format(block_entry_key(covering[0])))
+            covered = self.simple_switch_app.blocked_trie.covered(network)
+            self.simple_switch_app.block_ips([ip])
+            body = "Blocked IP: {}".format(block_entry_key(network))
+            if covered:
+                body += " (covers {})".format(', '.join(sorted(map(block_entry_key, covered))))
+            return Response(status=200, body=body)
         except Exception as e:
             return Response(status=500, body=str(e))
 
@@ -441,41 +3412,153 @@ class SimpleSwitchController(ControllerBase):
             ip = new_data.get('ip')
             if not ip:
                 return Response(status=400, body="Missing IP address.")
-            if ip not in self.simple_switch_app.blocked_ips:
+            try:
+                key = block_entry_key(parse_block_entry(ip))
+            except ValueError as e:
+                return Response(status=400, body="Invalid IP address or prefix: {}".format(e))
+            if key not in self.simple_switch_app.blocked_ips:
                 return Response(status=400, body="IP not in blocked list.")
-            self.simple_switch_app.blocked_ips.remove(ip)
-            for dp in self.simple_switch_app.datapaths.values():
-                self.simple_switch_app.unblock_ip(dp, ip)
-            return Response(status=200, body="Unblocked IP: {}".format(ip))
+            self.simple_switch_app.unblock_ips([key])
+            return Response(status=200, body="Unblocked IP: {}".format(key))
         except Exception as e:
             return Response(status=500, body=str(e))
 
-    # Api Port --------------------------------------------------------------------
-    @route('ports', url_ports, methods=['GET'])
-    def list_ports(self, req, **kwargs):
-        # Trả về danh sách tất cả các cổng và cổng bị chặn trên tất cả switch
-        ports_info = {}
-        for dpid, datapath in self.simple_switch_app.datapaths.items():
-            # Lấy danh sách mô tả các cổng từ switch
-            port_list = []
-            for port_no, port_desc in datapath.ports.items():
-                port_list.append({
-                    "port_no": port_no,
-                    "name": port_desc.name.decode('utf-8'),
-                    "hw_addr": port_desc.hw_addr
-                })
+    @route('block_ips', url_block_ips, methods=['POST'])
+    def block_ips(self, req, **kwargs):
+        return self._bulk_ips(req, block=True)
 
-            # Lấy danh sách cổng bị chặn từ blocked_ports
-            blocked_ports = list(self.simple_switch_app.blocked_ports.get(dpid, set()))
+    @route('unblock_ips', url_unblock_ips, methods=['POST'])
+    def unblock_ips(self, req, **kwargs):
+        return self._bulk_ips(req, block=False)
 
-            # Thêm thông tin vào kết quả trả về
-            ports_info[str(dpid)] = {
-                "all_ports": port_list,
-                "blocked_ports": blocked_ports
+    def _bulk_ips(self, req, block):
+        switch_app = self.simple_switch_app
+        try:
+            ips = (req.json if req.body else {}).get('ips')
+            if not isinstance(ips, list) or not ips:
+                return Response(status=400, body="Missing IP address list.")
+            try:
+                networks = [parse_block_entry(ip) for ip in ips]
+            except ValueError as e:
+                return Response(status=400, body="Invalid IP address or prefix: {}".format(e))
+            keys = list(dict.fromkeys(block_entry_key(network) for network in networks))
+            if block:
+                # Broadest prefixes first, so an entry covered by another one in
+                # the same request is skipped whatever order they were given in
+                accepted = PrefixTrie()
+                for network in sorted(map(parse_block_entry, keys), key=lambda network: network.prefixlen):
+                    if not switch_app.blocked_trie.covering(network) and not accepted.covering(network):
+                        accepted.insert(network)
+                accepted = set(map(block_entry_key, accepted.networks()))
+                changed = [key for key in keys if key in accepted]
+                # Narrower entries already on the list that a new prefix now
+                # covers; they stay listed, and their drop rules are merged
+                covers = {}
+                for key in changed:
+                    covered = switch_app.blocked_trie.covered(parse_block_entry(key))
+                    if covered:
+                        covers[key] = sorted(map(block_entry_key, covered))
+                result = switch_app.block_ips(changed)
+            else:
+                changed = [key for key in keys if key in switch_app.blocked_ips]
+                result = switch_app.unblock_ips(changed)
+            body = {
+                'blocked' if block else 'unblocked': changed,
+                'skipped': [key for key in keys if key not in changed],
+                'switches': result.wait(switch_app.flow_batch_timeout),
             }
-        body = json.dumps(ports_info)
+            if block:
+                body['covers'] = covers
+            return Response(content_type='application/json; charset=utf-8', body=json.dumps(body))
+        except Exception as e:
+            return Response(status=500, body=str(e))
+
+    @route('block_ports', url_block_ports, methods=['POST'])
+    def block_ports(self, req, **kwargs):
+        return self._bulk_ports(req, block=True)
+
+    @route('unblock_ports', url_unblock_ports, methods=['POST'])
+    def unblock_ports(self, req, **kwargs):
+        return self._bulk_ports(req, block=False)
+
+    def _bulk_ports(self, req, block):
+        switch_app = self.simple_switch_app
+        try:
+            data = json.loads(req.body)
+            ports = [(int(entry['dpid']), int(entry['port_no'])) for entry in data['ports']]
+            if block:
+                result = switch_app.block_ports(ports)
+            else:
+                result = switch_app.unblock_ports(ports)
+            body = {'status': 'success', 'switches': result.wait(switch_app.flow_batch_timeout)}
+            return Response(content_type='application/json; charset=utf-8', body=json.dumps(body))
+        except Exception as e:
+            # Trả về lỗi dưới dạng JSON
+            error_message = {'status': 'error', 'message': str(e)}
+            return Response(
+                status=500,
+                content_type='application/json; charset=utf-8',
+                body=json.dumps(error_message)
+            )
+
+    @route('top_talkers', url_top_talkers, methods=['GET'])
+    def list_top_talkers(self, req, **kwargs):
+        try:
+            n = int(req.GET.get('n', 10))
+        except ValueError:
+            return Response(status=400, body="Invalid n.")
+        body = json.dumps(self.simple_switch_app.top_talkers(n))
         return Response(content_type='application/json; charset=utf-8', body=body)
 
+    @route('topology', url_topology, methods=['GET'])
+    def get_topology(self, req, **kwargs):
+        return self._snapshot_response(req, 'topology')
+
+    @route('throughput_history', url_throughput_history, methods=['GET'])
+    def get_throughput_history(self, req, **kwargs):
+        # ?start=&end= in epoch seconds (default: the last 5 minutes), optional
+        # resolution, dpid and port. Points are `resolution` seconds apart from
+        # `start`, null where no sample was taken.
+        try:
+            end = float(req.GET.get('end', time.time()))
+            start = float(req.GET.get('start', end - 300))
+            resolution = int(req.GET['resolution']) if 'resolution' in req.GET else None
+            dpid = int(req.GET['dpid']) if 'dpid' in req.GET else None
+            port_no = int(req.GET['port']) if 'port' in req.GET else None
+        except ValueError:
+            return Response(status=400, body="Invalid query.")
+        # float() accepts inf/nan, which would overflow the bucket arithmetic
+        if not (math.isfinite(start) and math.isfinite(end)) or start <= 0 or end <= 0:
+            return Response(status=400, body="start and end must be positive epoch seconds.")
+        if start > end:
+            return Response(status=400, body="start is after end.")
+        window = self.simple_switch_app.throughput_window(start, end, resolution, dpid, port_no)
+        if window is None:
+            return Response(status=400, body="Invalid resolution.")
+        return Response(content_type='application/json; charset=utf-8', body=json.dumps(window))
+
+    @route('thresholds', url_thresholds, methods=['GET'])
+    def list_thresholds(self, req, **kwargs):
+        return self._snapshot_response(req, 'thresholds')
+
+    @route('threshold', url_threshold, methods=['POST'])
+    def set_threshold(self, req, **kwargs):
+        # Body: [{"switch": dpid, "port": port_no, "threshold": bytes/s or null}]
+        try:
+            entries = json.loads(req.body)
+        except ValueError:
+            entries = None
+        if not isinstance(entries, list):
+            return Response(status=400, content_type='application/json; charset=utf-8',
+                            body=json.dumps(['Error: expected a list of {switch, port, threshold}']))
+        body = json.dumps(self.simple_switch_app.set_thresholds(entries))
+        return Response(content_type='application/json; charset=utf-8', body=body)
+
+    # Api Port --------------------------------------------------------------------
+    @route('ports', url_ports, methods=['GET'])
+    def list_ports(self, req, **kwargs):
+        return self._snapshot_response(req, 'ports')
+
     @route('block_port', url_block_port, methods=['POST'])
     def block_port(self, req, **kwargs):
         switch_app = self.simple_switch_app
@@ -523,17 +3606,3 @@ class SimpleSwitchController(ControllerBase):
                 content_type='application/json; charset=utf-8',
                 body=json.dumps(error_message)
             )
-    
-    # @route('ip_to_port', '/ip_to_port', methods=['GET'])
-    # def list_ip_to_port(self, req, **kwargs):
-    #     """
-    #     Trả về danh sách IP và cổng mà chúng kết nối với từng switch.
-    #     """
-    #     ip_to_port_info = {}
-    #     for dpid, ip_ports in self.simple_switch_app.ip_to_port.items():
-    #         ip_to_port_info[str(dpid)] = [
-    #             {"ip": ip, "port": port} for ip, port in ip_ports.items()
-    #         ]
-        
-    #     body = json.dumps(ip_to_port_info, indent=4)
-    #     return Response(content_type='application/json; charset=utf-8', body=body)
\ No newline at end of file
@@ -0,0 +1,548 @@
+##
+## Microbenchmarks for the Ryu controller app (ryu.py)
+##
+## Usage: python ryu_bench.py packet-in [--count N] [--hosts N] [--ports N]
+##        python ryu_bench.py flow-mod [--ips N] [--switches N] [--mode barrier|bundle]
+##        python ryu_bench.py load [--switches N] [--ports M] [--duration S] [--packet-in-rate R] ...
+##
+import argparse
+import array
+import importlib.util
+import json
+import os
+import random
+import resource
+import sys
+import tempfile
+import time
+import tracemalloc
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+# Running this script puts its directory first on sys.path, where ryu.py would
+# shadow the ryu package itself
+sys.path = [p for p in sys.path if os.path.abspath(p or os.curdir) != HERE]
+
+from ryu.controller import ofp_event
+from ryu.controller.handler import MAIN_DISPATCHER, DEAD_DISPATCHER
+from ryu.lib.packet import packet, ethernet, ether_types, ipv4, arp, udp, vlan
+from ryu.ofproto import ofproto_v1_3, ofproto_v1_3_parser
+
+CONTROLLER_FILE = os.path.join(HERE, 'ryu.py')
+
+
+def load_controller():
+    # ryu.py shares its module name with the ryu package, so load it by path
+    spec = importlib.util.spec_from_file_location('dynamic_controller_traffic', CONTROLLER_FILE)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+class BenchDatapath(object):
+    # Stand-in for ryu.controller.controller.Datapath: real OpenFlow 1.3
+    # encoding, no socket. Outgoing messages are serialized and counted, and
+    # barrier and stats requests are queued so the caller can answer them.
+    def __init__(self, dpid):
+        self.id = dpid
+        self.ofproto = ofproto_v1_3
+        self.ofproto_parser = ofproto_v1_3_parser
+        self.ports = {}
+        self.xid = 0
+        self.sent = 0
+        self.sent_bytes = 0
+        self.sent_types = {}
+        self.barriers = []
+        self.requests = []
+        self.flows = {}
+
+    def set_xid(self, msg):
+        self.xid = (self.xid + 1) & 0xffffffff
+        msg.set_xid(self.xid)
+        return self.xid
+
+    def send_msg(self, msg):
+        if msg.xid is None:
+            self.set_xid(msg)
+        msg.serialize()
+        self.sent += 1
+        self.sent_bytes += len(msg.buf)
+        name = type(msg).__name__
+        self.sent_types[name] = self.sent_types.get(name, 0) + 1
+        if isinstance(msg, ofproto_v1_3_parser.OFPBarrierRequest):
+            self.barriers.append(msg.xid)
+        elif isinstance(msg, (ofproto_v1_3_parser.OFPPortStatsRequest, ofproto_v1_3_parser.OFPFlowStatsRequest)):
+            self.requests.append(msg)
+        elif isinstance(msg, ofproto_v1_3_parser.OFPFlowMod):
+            self._flow_mod(msg)
+
+    def _flow_mod(self, mod):
+        # Just enough of a flow table to answer flow stats requests
+        ofproto = self.ofproto
+        items = tuple(mod.match.items())
+        if mod.command == ofproto.OFPFC_ADD:
+            self.flows[(mod.table_id, mod.priority, items)] = [mod, time.time()]
+        elif mod.command in (ofproto.OFPFC_DELETE, ofproto.OFPFC_DELETE_STRICT):
+            for key, (flow, added) in list(self.flows.items()):
+                if mod.command == ofproto.OFPFC_DELETE_STRICT:
+                    hit = key[1:] == (mod.priority, items)
+                else:
+                    hit = (flow.cookie & mod.cookie_mask) == (mod.cookie & mod.cookie_mask) and \
+                        all(flow.match.get(field) == value for field, value in items)
+                if hit:
+                    del self.flows[key]
+
+    def barrier_replies(self):
+        # EventOFPBarrierReply events for the barriers sent so far
+        events = []
+        for xid in self.barriers:
+            reply = ofproto_v1_3_parser.OFPBarrierReply(self)
+            reply.xid = xid
+            events.append(ofp_event.EventOFPBarrierReply(reply))
+        self.barriers = []
+        return events
+
+
+class _NullWSGI(object):
+    def register(self, controller, data):
+        pass
+
+
+def make_app(controller):
+    # SimpleSwitch13 without the Prometheus HTTP listener or the REST server.
+    # Journal and snapshots go to a scratch directory unless SDN_STATE_DIR is set.
+    controller.start_http_server = lambda *args, **kwargs: None
+    os.environ.setdefault('SDN_STATE_DIR', tempfile.mkdtemp(prefix='ryu_bench_'))
+    return controller.SimpleSwitch13(wsgi=_NullWSGI())
+
+
+def build_frames(src_mac='00:00:00:00:00:01', src_ip='10.0.0.1'):
+    # One ARP broadcast and one IPv4/UDP unicast frame, the two common packet-in
+    # shapes, and the same UDP frame carrying an 802.1Q tag
+    arp_pkt = packet.Packet()
+    arp_pkt.add_protocol(ethernet.ethernet(dst='ff:ff:ff:ff:ff:ff', src=src_mac,
+                                           ethertype=ether_types.ETH_TYPE_ARP))
+    arp_pkt.add_protocol(arp.arp(src_mac=src_mac, src_ip=src_ip,
+                                 dst_mac='00:00:00:00:00:00', dst_ip='10.0.0.2'))
+    arp_pkt.serialize()
+
+    udp_pkt = packet.Packet()
+    udp_pkt.add_protocol(ethernet.ethernet(dst='00:00:00:00:00:02', src=src_mac,
+                                           ethertype=ether_types.ETH_TYPE_IP))
+    udp_pkt.add_protocol(ipv4.ipv4(src=src_ip, dst='10.0.0.2', proto=17))
+    udp_pkt.add_protocol(udp.udp(src_port=5000, dst_port=5001))
+    udp_pkt.add_protocol(b'x' * 64)
+    udp_pkt.serialize()
+
+    vlan_pkt = packet.Packet()
+    vlan_pkt.add_protocol(ethernet.ethernet(dst='00:00:00:00:00:02', src=src_mac,
+                                            ethertype=ether_types.ETH_TYPE_8021Q))
+    vlan_pkt.add_protocol(vlan.vlan(vid=10, ethertype=ether_types.ETH_TYPE_IP))
+    vlan_pkt.add_protocol(ipv4.ipv4(src=src_ip, dst='10.0.0.2', proto=17))
+    vlan_pkt.add_protocol(udp.udp(src_port=5000, dst_port=5001))
+    vlan_pkt.add_protocol(b'x' * 64)
+    vlan_pkt.serialize()
+
+    return [bytes(arp_pkt.data), bytes(udp_pkt.data), bytes(vlan_pkt.data)]
+
+
+def _rate(parse, frames, count):
+    start = time.perf_counter()
+    for i in range(count):
+        parse(frames[i % len(frames)])
+    return count / (time.perf_counter() - start)
+
+
+def _packet_in_events(dp, hosts, ports):
+    # The build_frames() shapes sent by `hosts` sources spread over `ports` ports
+    parser = dp.ofproto_parser
+    ofproto = dp.ofproto
+    for port_no in range(1, ports + 1):
+        dp.ports[port_no] = parser.OFPPort(
+            port_no=port_no, hw_addr=FabricSimulator.host_mac(dp.id, port_no, 0xfe),
+            name=('s%d-eth%d' % (dp.id, port_no)).encode(), config=0, state=0,
+            curr=0, advertised=0, supported=0, peer=0, curr_speed=0, max_speed=0)
+    events = []
+    for host in range(1, hosts + 1):
+        in_port = host % ports + 1
+        for data in build_frames('02:00:00:00:%02x:%02x' % (host >> 8 & 255, host & 255),
+                                 '10.0.%d.%d' % (host >> 8 & 255, host & 255)):
+            msg = parser.OFPPacketIn(dp, buffer_id=ofproto.OFP_NO_BUFFER, total_len=len(data),
+                                     reason=ofproto.OFPR_NO_MATCH, table_id=0, cookie=0,
+                                     match=parser.OFPMatch(in_port=in_port), data=data)
+            msg.msg_len = ofproto.OFP_PACKET_IN_SIZE + len(data)
+            events.append(ofp_event.EventOFPPacketIn(msg))
+    return events
+
+
+def _handler_rate(app, dp, events, count):
+    # Time _packet_in_handler alone; barrier replies are answered between calls
+    handler = app._packet_in_handler
+    elapsed = 0.0
+    for i in range(count):
+        ev = events[i % len(events)]
+        start = time.perf_counter()
+        handler(ev)
+        elapsed += time.perf_counter() - start
+        for reply in dp.barrier_replies():
+            app._barrier_reply_handler(reply)
+    return count / elapsed
+
+
+def bench_packet_in(args):
+    # The whole packet-in handler with the fast path on and off, plus the
+    # parsers on their own
+    controller = load_controller()
+    frames = build_frames()
+
+    for data in frames:
+        assert controller.parse_eth_ipv4(data) == controller.parse_packet(data)
+
+    app = make_app(controller)
+    # Admission limits would turn most of the run into drops
+    app.switch_packet_in_rate = app.switch_packet_in_burst = 1e12
+    app.source_packet_in_rate = app.source_packet_in_burst = 1e12
+    dp = BenchDatapath(1)
+    events = _packet_in_events(dp, args.hosts, args.ports)
+    app.datapaths[dp.id] = dp
+    _handler_rate(app, dp, events, len(events))  # learn every host first
+
+    app.fast_path = False
+    full = _rate(controller.parse_packet, frames, args.count)
+    full_handler = _handler_rate(app, dp, events, args.count)
+    app.fast_path = True
+    fast = _rate(controller.parse_eth_ipv4, frames, args.count)
+    fast_handler = _handler_rate(app, dp, events, args.count)
+    print('full parse: %12.0f packet-ins/s %12.0f parses/s' % (full_handler, full))
+    print('fast path:  %12.0f packet-ins/s %12.0f parses/s' % (fast_handler, fast))
+    print('speedup:    %12.1fx %13.1fx' % (fast_handler / full_handler, fast / full))
+
+
+def bench_flow_mod(args):
+    controller = load_controller()
+    app = make_app(controller)
+    app.flow_batch_mode = args.mode
+    datapaths = [BenchDatapath(dpid) for dpid in range(1, args.switches + 1)]
+    for dp in datapaths:
+        app.datapaths[dp.id] = dp
+    # Spread the addresses out so prefix aggregation cannot merge them
+    ips = ['10.%d.%d.%d' % (i >> 16 & 255, i >> 8 & 255, i & 255) for i in range(1, 4 * args.ips, 4)]
+    flow_mods = len(ips) * len(datapaths)
+
+    # Previous behaviour: one unconfirmed send per IP per switch
+    start = time.perf_counter()
+    for ip in ips:
+        for dp in datapaths:
+            app.block_ip(dp, ip)
+    loop = time.perf_counter() - start
+
+    # Batched: one batch per switch, confirmed by its barrier
+    start = time.perf_counter()
+    result = app.block_ips(ips)
+    for dp in datapaths:
+        for ev in dp.barrier_replies():
+            app._barrier_reply_handler(ev)
+    batched = time.perf_counter() - start
+    status = result.wait(0)
+
+    confirmed = sum(1 for entry in status.values() if entry['status'] == 'ok')
+    print('flow-mods:          %12d (%d IPs x %d switches)' % (flow_mods, len(ips), len(datapaths)))
+    print('per-IP loop:        %12.0f flow-mods/s, unconfirmed' % (flow_mods / loop))
+    print('batched (%s): %12.0f flow-mods/s, %d/%d switches confirmed'
+          % (args.mode.ljust(7), flow_mods / batched, confirmed, len(datapaths)))
+
+
+class FabricSimulator(object):
+    # N switches x M ports with one host behind every port. Drives the app's
+    # real event handlers with synthetic OpenFlow 1.3 events and answers the
+    # barrier and stats requests the app sends back.
+    def __init__(self, app, switches, ports, port_rate, hot_ports, hot_rate):
+        self.app = app
+        self.parser = ofproto_v1_3_parser
+        self.datapaths = [BenchDatapath(dpid) for dpid in range(1, switches + 1)]
+        self.ports = ports
+        self.rates = {}
+        self.counters = {}
+        self.counter_time = {}
+        for dp in self.datapaths:
+            for port_no in range(1, ports + 1):
+                dp.ports[port_no] = self.parser.OFPPort(
+                    port_no=port_no, hw_addr=self.host_mac(dp.id, port_no, 0xfe),
+                    name=('s%d-eth%d' % (dp.id, port_no)).encode(), config=0, state=0,
+                    curr=0, advertised=0, supported=0, peer=0, curr_speed=0, max_speed=0)
+                hot = random.random() < hot_ports
+                self.rates[(dp.id, port_no)] = hot_rate if hot else port_rate
+                self.counters[(dp.id, port_no)] = 0.0
+            self.counter_time[dp.id] = time.time()
+        self.frames = {}
+        self.latency = {}
+        self.events = {}
+
+    @staticmethod
+    def host_mac(dpid, port_no, tag=2):
+        return '%02x:00:%02x:%02x:%02x:%02x' % (tag, dpid >> 8 & 255, dpid & 255, port_no >> 8 & 255, port_no & 255)
+
+    @staticmethod
+    def host_ip(dpid, port_no):
+        return '10.%d.%d.%d' % (dpid & 255, port_no >> 8 & 255, port_no & 255)
+
+    def frame(self, dpid, src_port, dst_port, broadcast):
+        # Frames are built once per (switch, src, dst) shape and reused
+        key = (dpid, src_port, dst_port, broadcast)
+        data = self.frames.get(key)
+        if data is None:
+            src_mac, src_ip = self.host_mac(dpid, src_port), self.host_ip(dpid, src_port)
+            dst_mac, dst_ip = self.host_mac(dpid, dst_port), self.host_ip(dpid, dst_port)
+            pkt = packet.Packet()
+            if broadcast:
+                pkt.add_protocol(ethernet.ethernet(dst='ff:ff:ff:ff:ff:ff', src=src_mac,
+                                                   ethertype=ether_types.ETH_TYPE_ARP))
+                pkt.add_protocol(arp.arp(src_mac=src_mac, src_ip=src_ip,
+                                         dst_mac='00:00:00:00:00:00', dst_ip=dst_ip))
+            else:
+                pkt.add_protocol(ethernet.ethernet(dst=dst_mac, src=src_mac,
+                                                   ethertype=ether_types.ETH_TYPE_IP))
+                pkt.add_protocol(ipv4.ipv4(src=src_ip, dst=dst_ip, proto=17))
+                pkt.add_protocol(udp.udp(src_port=5000, dst_port=5001))
+                pkt.add_protocol(b'x' * 64)
+            pkt.serialize()
+            data = self.frames[key] = bytes(pkt.data)
+        return data
+
+    def _run(self, kind, handler, ev):
+        start = time.perf_counter()
+        handler(ev)
+        elapsed = time.perf_counter() - start
+        samples = self.latency.get(kind)
+        if samples is None:
+            samples = self.latency[kind] = array.array('d')
+        samples.append(elapsed)
+
+    def connect(self, dp):
+        features = self.parser.OFPSwitchFeatures(dp, datapath_id=dp.id, n_buffers=0, n_tables=254,
+                                                 auxiliary_id=0, capabilities=0)
+        features.datapath = dp
+        self._run('switch_features', self.app.switch_features_handler, ofp_event.EventOFPSwitchFeatures(features))
+        self._run('state_change', self.app._state_change_handler, self._state_change(dp, MAIN_DISPATCHER))
+
+    def disconnect(self, dp):
+        dp.flows.clear()
+        dp.barriers = []
+        dp.requests = []
+        self._run('state_change', self.app._state_change_handler, self._state_change(dp, DEAD_DISPATCHER))
+
+    @staticmethod
+    def _state_change(dp, state):
+        ev = ofp_event.EventOFPStateChange(dp)
+        ev.state = state
+        return ev
+
+    def packet_in(self, broadcast_ratio):
+        dp = random.choice(self.datapaths)
+        src_port = random.randint(1, self.ports)
+        dst_port = random.randint(1, self.ports)
+        data = self.frame(dp.id, src_port, dst_port, random.random() < broadcast_ratio)
+        ofproto = dp.ofproto
+        msg = self.parser.OFPPacketIn(dp, buffer_id=ofproto.OFP_NO_BUFFER, total_len=len(data),
+                                      reason=ofproto.OFPR_NO_MATCH, table_id=0, cookie=0,
+                                      match=self.parser.OFPMatch(in_port=src_port), data=data)
+        msg.msg_len = ofproto.OFP_PACKET_IN_SIZE + len(data)
+        self._run('packet_in', self.app._packet_in_handler, ofp_event.EventOFPPacketIn(msg))
+
+    def reconnect(self):
+        dp = random.choice(self.datapaths)
+        self.disconnect(dp)
+        self.connect(dp)
+
+    def answer(self):
+        # Reply to everything the app has sent since the last call, like a switch would
+        for dp in self.datapaths:
+            requests, dp.requests = dp.requests, []
+            for req in requests:
+                if isinstance(req, self.parser.OFPPortStatsRequest):
+                    self._run('port_stats', self.app._port_stats_reply_handler, self._port_stats(dp, req))
+                else:
+                    self._run('flow_stats', self.app._flow_stats_reply_handler, self._flow_stats(dp, req))
+            for ev in dp.barrier_replies():
+                self._run('barrier', self.app._barrier_reply_handler, ev)
+
+    def _advance(self, dp):
+        now = time.time()
+        elapsed = now - self.counter_time[dp.id]
+        self.counter_time[dp.id] = now
+        for port_no in dp.ports:
+            self.counters[(dp.id, port_no)] += self.rates[(dp.id, port_no)] * elapsed
+
+    def _port_stats(self, dp, req):
+        self._advance(dp)
+        ports = dp.ports if req.port_no == dp.ofproto.OFPP_ANY else (req.port_no,)
+        body = []
+        for port_no in ports:
+            count = int(self.counters[(dp.id, port_no)])
+            body.append(self.parser.OFPPortStats(port_no=port_no, rx_packets=count >> 10, tx_packets=count >> 10,
+                                                 rx_bytes=count, tx_bytes=count, rx_dropped=0, tx_dropped=0,
+                                                 rx_errors=0, tx_errors=0, rx_frame_err=0, rx_over_err=0,
+                                                 rx_crc_err=0, collisions=0, duration_sec=0, duration_nsec=0))
+        msg = self.parser.OFPPortStatsReply(dp, type_=dp.ofproto.OFPMP_PORT_STATS, flags=0, body=body)
+        msg.xid = req.xid
+        return ofp_event.EventOFPPortStatsReply(msg)
+
+    def _flow_stats(self, dp, req):
+        self._advance(dp)
+        now = time.time()
+        body = []
+        for (table_id, priority, items), (mod, added) in dp.flows.items():
+            in_port = mod.match.get('in_port')
+            byte_count = int(self.rates.get((dp.id, in_port), 0) * (now - added))
+            body.append(self.parser.OFPFlowStats(table_id=table_id, duration_sec=int(now - added), duration_nsec=0,
+                                                 priority=priority, idle_timeout=mod.idle_timeout,
+                                                 hard_timeout=mod.hard_timeout, flags=0, cookie=mod.cookie,
+                                                 packet_count=byte_count >> 10, byte_count=byte_count,
+                                                 match=mod.match, instructions=mod.instructions))
+        msg = self.parser.OFPFlowStatsReply(dp, type_=dp.ofproto.OFPMP_FLOW, flags=0, body=body)
+        msg.xid = req.xid
+        return ofp_event.EventOFPFlowStatsReply(msg)
+
+    def housekeeping(self):
+        # One pass of the app's background loops; the hub threads never run here
+        now = time.time()
+        self._run('monitor', self.app._monitor_tick, now)
+        self._run('aging', self.app._aging_tick, now)
+
+
+def _percentile(ordered, q):
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+def _app_sizes(app):
+    # Entry counts of the app's growing structures, to spot leaks next to the memory numbers
+    return {
+        'mac_to_port': sum(len(table) for table in app.mac_to_port.values()),
+        'hosts': len(app.inventory),
+        'host_last_seen': len(app.host_last_seen),
+        'flows_in_flight': len(app.flows_in_flight),
+        'barrier_callbacks': len(app.barrier_callbacks),
+        'source_buckets': len(app.source_buckets),
+        'heavy_hitters': len(app.heavy_hitters),
+        'blocked_ports': len(app.port_blocks),
+        'blocked_ips': len(app.blocked_ips),
+    }
+
+
+def bench_load(args):
+    random.seed(args.seed)
+    controller = load_controller()
+    app = make_app(controller)
+    app.poll_interval = app.flow_stats_interval = args.stats_interval
+    sim = FabricSimulator(app, args.switches, args.ports, args.port_rate, args.hot_ports, args.hot_rate)
+
+    if args.trace_memory:
+        tracemalloc.start()
+    rss_start = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    for dp in sim.datapaths:
+        sim.connect(dp)
+    sim.answer()
+    traced_start = tracemalloc.get_traced_memory()[0] if args.trace_memory else 0
+
+    # Each source fires on its own schedule; when the handlers cannot keep up the
+    # schedule slips and the achieved rate shows it
+    sources = {'packet_in': (args.packet_in_rate, lambda: sim.packet_in(args.broadcast_ratio)),
+               'reconnect': (args.reconnect_rate, sim.reconnect),
+               'housekeeping': (1.0 / app.poll_tick, sim.housekeeping)}
+    start = time.perf_counter()
+    end = start + args.duration
+    due = {name: start for name, (rate, fire) in sources.items() if rate > 0}
+    fired = dict.fromkeys(due, 0)
+    while due:
+        name = min(due, key=due.get)
+        now = time.perf_counter()
+        if due[name] >= end or now >= end:
+            break
+        if due[name] > now:
+            time.sleep(due[name] - now)
+        sources[name][1]()
+        sim.answer()
+        fired[name] += 1
+        due[name] += 1.0 / sources[name][0]
+    elapsed = time.perf_counter() - start
+
+    result = {
+        'switches': args.switches, 'ports': args.ports, 'duration': elapsed,
+        'events': {},
+        'sent': {},
+        'sent_bytes': sum(dp.sent_bytes for dp in sim.datapaths),
+        'rss_growth_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - rss_start,
+        'app': _app_sizes(app),
+    }
+    if args.trace_memory:
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        result['traced_growth_kb'] = (current - traced_start) / 1024.0
+        result['traced_peak_kb'] = peak / 1024.0
+    for kind, samples in sorted(sim.latency.items()):
+        ordered = sorted(samples)
+        result['events'][kind] = {
+            'count': len(ordered), 'rate': len(ordered) / elapsed,
+            'p50_us': _percentile(ordered, 0.50) * 1e6, 'p95_us': _percentile(ordered, 0.95) * 1e6,
+            'p99_us': _percentile(ordered, 0.99) * 1e6, 'max_us': ordered[-1] * 1e6,
+        }
+    for dp in sim.datapaths:
+        for name, count in dp.sent_types.items():
+            result['sent'][name] = result['sent'].get(name, 0) + count
+    result['target'] = {name: sources[name][0] for name in fired}
+
+    if args.json:
+        print(json.dumps(result, indent=2, sort_keys=True))
+        return
+    print('%d switches x %d ports, %.1f s' % (args.switches, args.ports, elapsed))
+    print('%-16s %10s %10s %10s %10s %10s %10s' % ('event', 'count', 'events/s', 'p50 us', 'p95 us', 'p99 us', 'max us'))
+    for kind, stats in result['events'].items():
+        print('%-16s %10d %10.0f %10.1f %10.1f %10.1f %10.1f' % (kind, stats['count'], stats['rate'], stats['p50_us'],
+                                                             stats['p95_us'], stats['p99_us'], stats['max_us']))
+    for name, rate in sorted(result['target'].items()):
+        print('%-16s target %.1f/s, achieved %.1f/s' % (name, rate, fired[name] / elapsed))
+    print('sent: %s (%d bytes)' % (', '.join('%s=%d' % item for item in sorted(result['sent'].items())),
+                                   result['sent_bytes']))
+    print('max RSS growth: %d KB' % result['rss_growth_kb'])
+    if args.trace_memory:
+        print('traced growth: %.0f KB (peak %.0f KB)' % (result['traced_growth_kb'], result['traced_peak_kb']))
+    print('app state: %s' % ', '.join('%s=%d' % item for item in sorted(result['app'].items())))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Ryu controller microbenchmarks')
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    p = sub.add_parser('packet-in', help='packet-in handler and parse rate, full parse vs fast path')
+    p.add_argument('--count', type=int, default=200000)
+    p.add_argument('--hosts', type=int, default=256, help='source MACs sending packet-ins')
+    p.add_argument('--ports', type=int, default=24)
+    p.set_defaults(func=bench_packet_in)
+
+    p = sub.add_parser('flow-mod', help='bulk block_ip throughput, per-IP loop vs batched')
+    p.add_argument('--ips', type=int, default=500)
+    p.add_argument('--switches', type=int, default=50)
+    p.add_argument('--mode', choices=('barrier', 'bundle'), default='barrier')
+    p.set_defaults(func=bench_flow_mod)
+
+    p = sub.add_parser('load', help='simulated switches driving the real handlers at set rates')
+    p.add_argument('--switches', type=int, default=10)
+    p.add_argument('--ports', type=int, default=24)
+    p.add_argument('--duration', type=float, default=10.0, help='seconds')
+    p.add_argument('--packet-in-rate', type=float, default=2000, help='packet-ins/s, 0 to disable')
+    p.add_argument('--broadcast-ratio', type=float, default=0.2, help='share of ARP broadcast packet-ins')
+    p.add_argument('--stats-interval', type=float, default=1.0, help='port/flow stats poll interval, seconds')
+    p.add_argument('--reconnect-rate', type=float, default=0.2, help='switch disconnect+reconnect/s, 0 to disable')
+    p.add_argument('--port-rate', type=float, default=100000, help='bytes/s on every port')
+    p.add_argument('--hot-ports', type=float, default=0.0, help='share of ports running at --hot-rate')
+    p.add_argument('--hot-rate', type=float, default=2000000, help='bytes/s on hot ports')
+    p.add_argument('--seed', type=int, default=1)
+    p.add_argument('--trace-memory', action='store_true', help='tracemalloc growth (slows the handlers)')
+    p.add_argument('--json', action='store_true', help='machine-readable result for regression checks')
+    p.set_defaults(func=bench_load)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()